@@ -1,40 +1,90 @@
 #!/usr/bin/env python3
 """
 Script to add 5,000,000 coins to @ceosulim
+
+Also credits several users at once:
+    python add_coins_ceosulim.py @user1 1000 @user2 500
+    python add_coins_ceosulim.py credits.txt   (one "username amount" pair per line)
 """
 
-from database import init_database, admin_get_user_by_username, admin_add_coins, create_user
+import os
+import sys
+from database import (
+    get_db_connection, init_database, admin_add_coins_by_username, admin_add_coins_bulk, create_user
+)
+
+def parse_credits(args):
+    """Parse (username, amount) pairs from argv or from a file path"""
+    if len(args) == 1 and os.path.isfile(args[0]):
+        with open(args[0], encoding='utf-8') as f:
+            args = f.read().replace(',', ' ').split()
+
+    if len(args) % 2:
+        raise ValueError("Ожидаются пары: username количество")
+
+    return [(args[i].lstrip('@'), int(args[i + 1])) for i in range(0, len(args), 2)]
+
+def credit_admin(conn):
+    """Add 5,000,000 coins to @ceosulim, creating the user if needed; returns (user, amount)"""
+    # The name is resolved to one user, then credited and re-read by a single UPDATE ... RETURNING
+    amount = 5000000
+    user = admin_add_coins_by_username('ceosulim', amount, conn=conn)
 
-def main():
-    print("🔧 Инициализация базы данных...")
-    init_database()
-    
-    # Check if ceosulim exists
-    user = admin_get_user_by_username('ceosulim')
-    
     if not user:
         print("⚠️  Пользователь @ceosulim не найден. Создаю пользователя...")
         # Create user with a placeholder telegram_id (will be updated when they start the bot)
         # Using a special ID for admin user
         admin_id = 999999999  # Placeholder ID
-        create_user(admin_id, 'ceosulim', 'CEO Sulim')
-        user = admin_get_user_by_username('ceosulim')
+        create_user(admin_id, 'ceosulim', 'CEO Sulim', conn=conn)
         print(f"✅ Пользователь @ceosulim создан с ID {admin_id}")
-    
-    print(f"👤 Найден пользователь: @{user['username']}")
-    print(f"💰 Текущий баланс: {user['balance']} монет")
-    
-    # Add 5,000,000 coins
-    amount = 5000000
-    success = admin_add_coins(user['telegram_id'], amount)
-    
-    if success:
-        # Get updated user info
-        updated_user = admin_get_user_by_username('ceosulim')
+        user = admin_add_coins_by_username('ceosulim', amount, conn=conn)
+
+    return user, amount
+
+def report_admin_credit(user, amount):
+    """Print the balance change made by credit_admin"""
+    if user:
+        print(f"👤 Найден пользователь: @{user['username']}")
+        print(f"💰 Прежний баланс: {user['balance'] - amount} монет")
         print(f"✅ Успешно добавлено {amount:,} монет!")
-        print(f"💰 Новый баланс: {updated_user['balance']:,} монет")
+        print(f"💰 Новый баланс: {user['balance']:,} монет")
     else:
         print("❌ Ошибка при добавлении монет!")
 
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+
+    try:
+        credits = parse_credits(args) if args else None
+    except ValueError as e:
+        print(f"❌ Неверные аргументы: {e}")
+        return
+
+    # One connection is reused for every step of the run
+    conn = get_db_connection()
+
+    print("🔧 Инициализация базы данных...")
+    init_database(conn=conn)
+
+    # All mutations share one transaction: a single commit (and fsync) at the end,
+    # and nothing is written if any step fails
+    try:
+        if credits is None:
+            user, amount = credit_admin(conn)
+        else:
+            credited = admin_add_coins_bulk(credits, conn=conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        print("❌ Ошибка при добавлении монет! Изменения отменены.")
+        raise
+
+    if credits is None:
+        report_admin_credit(user, amount)
+        return
+
+    total = sum(amount for _, amount in credits)
+    print(f"✅ Пар в запросе: {len(credits)}, обновлено пользователей: {credited}, сумма: {total:,} монет")
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
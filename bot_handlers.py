@@ -3,49 +3,122 @@ Bot handlers for Durov's Prison game
 Handles all user interactions and bot commands
 """
 
+import asyncio
+import functools
+import html
 import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update, Bot
+from telegram.error import RetryAfter
 from telegram.ext import ContextTypes
 from database import (
     create_user, get_user, get_my_prisoners, get_random_prisoners,
     buy_prisoner, transfer_money, get_ownership_history, get_leaderboard,
     get_user_by_referral_code, update_user_info, send_prisoners_to_work,
     collect_work_rewards, get_work_status, buy_self_freedom, activate_shield,
-    check_shield_status, get_db_connection, add_referral_points,
+    check_shield_status, get_db_connection,
     get_sorted_prisoners, search_prisoners_by_username,
-    admin_add_coins, admin_set_coins, admin_set_points, admin_get_all_users,
+    admin_get_users_page, admin_count_users,
+    admin_add_coins_by_username, admin_set_coins_by_username, admin_set_points_by_username,
     admin_get_user_by_username, upgrade_prisoner, get_prisoner_upgrade_info,
-    get_profit_statistics
+    get_profit_statistics, get_user_by_username, display_name,
+    get_last_self_buyout_owner, get_price_analysis_bundle, get_prisoner_profile_bundle,
+    apply_referral_capture
 )
 from keyboards import (
     get_main_menu, get_profile_keyboard, get_prisoners_keyboard,
     get_search_keyboard, get_transfer_keyboard, get_leaderboard_keyboard,
     get_back_keyboard, get_invite_keyboard, get_find_prisoner_menu_keyboard,
-    get_search_results_keyboard, get_back_to_find_keyboard
+    get_search_results_keyboard, get_back_to_find_keyboard, get_prisoner_profile_keyboard
 )
 from messages import *
+from game_logic import GameLogic
 
 logger = logging.getLogger(__name__)
 
-# User states for conversation handling
-user_states = {}
-
 # Global bot instance for notifications
 bot_instance = None
 
+# Notifications are queued and sent in the background within Bot API limits
+NOTIFICATIONS_PER_SECOND = 30
+NOTIFICATION_CHAT_INTERVAL = 1.0
+notification_queue = None
+notification_worker_task = None
+# Pending deliveries; asyncio keeps only weak references to tasks
+notification_tasks = set()
+
+# Admin text commands: "<command> @username amount"
+ADMIN_TEXT_COMMAND_RE = re.compile(r'^(addcoins|setcoins|setpoints)\s+@?(\S+)\s+(-?\d+(?:\.\d+)?)\s*$', re.IGNORECASE)
+ADMIN_TEXT_COMMANDS = ('addcoins', 'setcoins', 'setpoints')
+
+# Bounded pool for blocking SQLite calls; each worker keeps its own thread-local connection
+db_executor = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2), thread_name_prefix='db')
+
+async def run_db(func, *args):
+    """Run a blocking database call in the DB pool so the event loop stays free"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args))
+
+async def no_result():
+    """Placeholder for an optional slot in asyncio.gather"""
+    return None
+
 def set_bot_instance(bot):
     """Set the bot instance for notifications"""
     global bot_instance
     bot_instance = bot
 
 async def send_notification(user_id: int, message: str):
-    """Send notification to a user"""
-    global bot_instance
-    if bot_instance:
+    """Queue a notification to a user; it is delivered in the background"""
+    global notification_queue, notification_worker_task
+    if not bot_instance:
+        return
+    
+    if notification_worker_task is None or notification_worker_task.done() or \
+            notification_worker_task.get_loop() is not asyncio.get_running_loop():
+        notification_queue = asyncio.Queue()
+        notification_worker_task = asyncio.create_task(notification_worker(notification_queue))
+    
+    notification_queue.put_nowait((user_id, message))
+
+async def notification_worker(queue: asyncio.Queue):
+    """Deliver queued notifications: at most 30 per second overall and one per second per chat"""
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(NOTIFICATIONS_PER_SECOND)
+    next_send_at = {}
+    
+    while True:
+        user_id, message = await queue.get()
+        now = loop.time()
+        
+        # Reserve the next free second for this chat so its messages keep their order
+        send_at = max(now, next_send_at.get(user_id, 0))
+        next_send_at[user_id] = send_at + NOTIFICATION_CHAT_INTERVAL
+        if len(next_send_at) > 10000:
+            next_send_at = {uid: at for uid, at in next_send_at.items() if at > now}
+        
+        task = asyncio.create_task(deliver_notification(queue, slots, user_id, message, send_at - now))
+        notification_tasks.add(task)
+        task.add_done_callback(notification_tasks.discard)
+
+async def deliver_notification(queue: asyncio.Queue, slots: asyncio.Semaphore, user_id: int,
+                               message: str, delay: float):
+    """Send one notification, holding a global slot for a second to respect the overall rate"""
+    if delay > 0:
+        await asyncio.sleep(delay)
+    
+    async with slots:
         try:
-            await bot_instance.send_message(chat_id=user_id, text=message, parse_mode='HTML')
+            await bot_instance.send_message(chat_id=user_id, text=message)
+        except RetryAfter as e:
+            logger.warning(f"Flood limit hit sending to {user_id}, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+            queue.put_nowait((user_id, message))
         except Exception as e:
             logger.error(f"Failed to send notification to {user_id}: {e}")
+        await asyncio.sleep(1)
 
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
@@ -55,72 +128,60 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     referrer_id = None
     if context.args:
         referral_code = context.args[0]
-        referrer = get_user_by_referral_code(referral_code)
+        referrer = await run_db(get_user_by_referral_code, referral_code)
         if referrer:
             referrer_id = referrer['telegram_id']
             logger.info(f"User {user.id} referred by {referrer_id}")
     
     # Update user info if they exist, or create new user
-    existing_user = get_user(user.id)
+    existing_user = await run_db(get_user, user.id)
+    captured = False
     if existing_user:
-        update_user_info(user.id, user.username, user.first_name)
         if referrer_id and not existing_user['owner_id']:
             # If user exists but has no owner, assign referrer as owner
-            from database import get_db_connection
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('UPDATE users SET owner_id = ? WHERE telegram_id = ?', 
-                         (referrer_id, user.id))
-            conn.commit()
-            
-            # Send capture message to new user
-            await update.message.reply_text(REFERRAL_CAPTURED_MESSAGE.format(
-                referrer_name=referrer.get('username', 'Неизвестный')
-            ))
-            
-            # Send notification to referrer
-            captured_name = user.username or user.first_name or f"ID{user.id}"
-            notification_text = REFERRAL_CAPTURED_NOTIFICATION.format(
-                captured_user=captured_name
-            )
-            await send_notification(referrer_id, notification_text)
+            captured = await run_db(apply_referral_capture, user.id, referrer_id, user.username, user.first_name)
+        else:
+            await run_db(update_user_info, user.id, user.username, user.first_name)
+    elif referrer_id:
+        # New user, referral point and ownership are written together
+        captured = await run_db(apply_referral_capture, user.id, referrer_id, user.username, user.first_name, True)
     else:
-        create_user(user.id, user.username, user.first_name, referrer_id)
-        if referrer_id:
-            # Send capture message to new user
-            await update.message.reply_text(REFERRAL_CAPTURED_MESSAGE.format(
-                referrer_name=referrer.get('username', 'Неизвестный')
-            ))
-            
-            # Send notification to referrer and award points
-            captured_name = user.username or user.first_name or f"ID{user.id}"
-            notification_text = REFERRAL_CAPTURED_NOTIFICATION.format(
-                captured_user=captured_name
-            )
-            await send_notification(referrer_id, notification_text)
-            
-            # Award 1 point for successful referral
-            add_referral_points(referrer_id)
+        await run_db(create_user, user.id, user.username, user.first_name)
+    
+    if captured:
+        # Send capture message to new user
+        await update.message.reply_text(REFERRAL_CAPTURED_MESSAGE.format(
+            referrer_name=referrer.get('username', 'Неизвестный')
+        ))
+        
+        # Send notification to referrer
+        captured_name = display_name(user)
+        notification_text = REFERRAL_CAPTURED_NOTIFICATION.format(
+            captured_user=captured_name
+        )
+        await send_notification(referrer_id, notification_text)
+    
+    # Owner is known without re-reading the user: existing owner or the referrer who just captured them
+    owner_id = (existing_user['owner_id'] if existing_user else None) or (referrer_id if captured else None)
     
     # Get user data for personalized message
-    user_data = get_user(user.id)
-    prisoners = get_my_prisoners(user.id)
+    user_data, prisoners, owner = await asyncio.gather(
+        run_db(get_user, user.id),
+        run_db(get_my_prisoners, user.id),
+        run_db(get_user, owner_id) if owner_id else no_result()
+    )
     
     # Format owner info
     owner_info = ""
-    if user_data and user_data['owner_id']:
-        owner = get_user(user_data['owner_id'])
-        if owner:
-            owner_name = owner.get('username', f"ID{owner['telegram_id']}")
-            owner_info = f"🧑‍💼 Владелец: @{owner_name}"
-        else:
-            owner_info = "🆓 Статус: Свободен"
+    if owner:
+        owner_name = display_name(owner)
+        owner_info = f"🧑‍💼 Владелец: @{owner_name}"
     else:
         owner_info = "🆓 Статус: Свободен"
     
     # Format start message with user data
     start_text = START_MESSAGE.format(
-        username=user.username or user.first_name or f"ID{user.id}",
+        username=display_name(user),
         balance=user_data['balance'] if user_data else 300,
         points=round(user_data['points'], 2) if user_data else 0.0,
         price=user_data['price'] if user_data else 100,
@@ -130,16 +191,14 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(
         start_text,
-        reply_markup=get_main_menu(),
-        parse_mode='HTML'
+        reply_markup=get_main_menu()
     )
 
 async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /help command"""
     await update.message.reply_text(
         HELP_MESSAGE,
-        reply_markup=get_main_menu(),
-        parse_mode='HTML'
+        reply_markup=get_main_menu()
     )
 
 async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -152,7 +211,7 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Store admin state
-    user_states[user.id] = 'admin_menu'
+    context.user_data['state'] = 'admin_menu'
     
     admin_text = """
 🛡️ <b>АДМИН ПАНЕЛЬ</b>
@@ -170,192 +229,157 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 <code>setpoints @username 100</code>
 """
     
-    await update.message.reply_text(admin_text, parse_mode='HTML')
+    await update.message.reply_text(admin_text)
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle inline keyboard button presses"""
     query = update.callback_query
     await query.answer()
     
-    user_id = query.from_user.id
     data = query.data
     
-    if data == "main_menu":
-        await show_main_menu(query)
-    elif data == "my_profile":
-        await show_my_profile(query)
-    elif data == "invite_friend":
-        await show_invite_link(query, context)
-    elif data == "my_prisoners":
-        await show_my_prisoners(query)
-    elif data == "find_prisoner":
-        await show_find_prisoner(query)
-    elif data == "search_by_username":
-        # Set user state to wait for username input
-        user_states[user_id] = "waiting_username_search"
-        await query.answer("Напишите имя пользователя для поиска", show_alert=True)
-    elif data.startswith("sort_"):
-        sort_type = data.split("_", 1)[1]
-        await show_find_prisoner(query, sort_by=sort_type)
-    elif data == "back_to_find":
-        await show_find_prisoner(query)
-    elif data == "balance_transfer":
-        await show_balance_transfer(query)
-    elif data == "leaderboard":
-        await show_leaderboard_menu(query)
-    elif data.startswith("view_profile_"):
-        prisoner_id = int(data.split("_")[2])
-        await show_prisoner_profile(query, prisoner_id)
-    elif data.startswith("buy_prisoner_"):
-        prisoner_id = int(data.split("_")[2])
-        await buy_prisoner_action(query, prisoner_id)
-    elif data.startswith("view_prisoner_"):
-        prisoner_id = int(data.split("_")[2])
-        await show_prisoner_details(query, prisoner_id)
-    elif data.startswith("history_"):
-        prisoner_id = int(data.split("_")[1])
-        await show_ownership_history(query, prisoner_id)
-    elif data.startswith("leaderboard_"):
-        category = data.split("_")[1]
-        await show_leaderboard(query, category)
-    elif data == "transfer_money":
-        user_states[user_id] = "waiting_transfer_amount"
-        await query.edit_message_text(
-            "💸 Введите сумму для перевода:",
-            reply_markup=get_back_keyboard()
-        )
-    elif data == "refresh_search":
-        await show_find_prisoner(query)
-    elif data == "send_to_work":
-        await send_prisoners_to_work_action(query)
-    elif data == "collect_work_reward":
-        await collect_work_reward_action(query)
-    elif data == "work_status":
-        await show_work_status(query)
-    elif data.startswith("self_buyout_"):
-        prisoner_id = int(data.split("_")[2])
-        await self_buyout_action(query, prisoner_id)
-    elif data.startswith("shield_"):
-        prisoner_id = int(data.split("_")[1])
-        await activate_shield_action(query, prisoner_id)
-    elif data.startswith("upgrade_"):
-        prisoner_id = int(data.split("_")[1])
-        await upgrade_prisoner_action(query, prisoner_id)
-    elif data == "price_analysis":
-        await show_price_analysis(query)
-    elif data == "back":
-        await show_main_menu(query)
+    # Any button press abandons a pending text input
+    context.user_data.pop('state', None)
+    context.user_data.pop('transfer_amount', None)
+    
+    action = CALLBACK_ACTIONS.get(data)
+    if action:
+        await action(query)
+        return
+    
+    action = INPUT_ACTIONS.get(data)
+    if action:
+        await action(query, context)
+        return
+    
+    # Actions on a single prisoner: one action character followed by the telegram_id
+    action, arg = PRISONER_ACTIONS.get(data[:1]), data[1:]
+    if not (action and arg.isdigit()):
+        # Buttons sent before the compact encoding: "<action>_<telegram_id>"
+        prefix, _, arg = data.rpartition("_")
+        action = PRISONER_ACTIONS.get(prefix)
+    if action and arg.isdigit():
+        await action(query, int(arg))
+        return
+    
+    # Actions with a text argument: "<action>_<value>"
+    prefix, _, arg = data.partition("_")
+    action = ARGUMENT_ACTIONS.get(prefix)
+    if action:
+        await action(query, arg)
+
+async def start_username_search(query, context):
+    """Wait for a username to search for"""
+    context.user_data['state'] = "waiting_username_search"
+    await query.answer("Напишите имя пользователя для поиска", show_alert=True)
+
+async def start_money_transfer(query, context):
+    """Wait for the amount to transfer"""
+    context.user_data['state'] = "waiting_transfer_amount"
+    await query.edit_message_text(
+        "💸 Введите сумму для перевода:",
+        reply_markup=get_back_keyboard()
+    )
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages based on user state"""
     user_id = update.effective_user.id
     text = update.message.text
     
-    if user_id in user_states:
-        state = user_states[user_id]
+    state = context.user_data.get('state')
+    
+    if state == "waiting_username_search":
+        # Search for prisoner by username
+        search_term = text.strip().replace('@', '')
+        context.user_data.pop('state', None)
+        
+        prisoners = await run_db(search_prisoners_by_username, search_term, user_id)
+        shown_term = html.escape(search_term)
         
-        if state == "waiting_username_search":
-            # Search for prisoner by username
-            search_term = text.strip().replace('@', '')
-            del user_states[user_id]
+        if not prisoners:
+            await update.message.reply_text(
+                f"🔍 Игрок '@{shown_term}' не найден или недоступен для покупки."
+            )
+        else:
+            search_text = f"🔍 Результат поиска '{shown_term}':\n\n"
+            search_text += format_prisoners_for_sale(prisoners)
             
-            prisoners = search_prisoners_by_username(search_term, user_id)
+            await update.message.reply_text(
+                search_text,
+                reply_markup=get_search_results_keyboard(prisoners, None, search_term)
+            )
+        return
+    
+    elif state == "waiting_transfer_amount":
+        try:
+            amount = int(text)
+            if amount <= 0:
+                await update.message.reply_text("Сумма должна быть положительной!")
+                return
             
-            if not prisoners:
-                await update.message.reply_text(
-                    f"🔍 Игрок '@{search_term}' не найден или недоступен для покупки."
-                )
-            else:
-                search_text = f"🔍 Результат поиска '{search_term}':\n\n"
-                
-                for prisoner in prisoners:
-                    name = prisoner['username'] or prisoner['first_name'] or f"ID{prisoner['telegram_id']}"
-                    owner_text = ""
-                    if prisoner['owner_id']:
-                        owner = get_user(prisoner['owner_id'])
-                        owner_name = owner['username'] or owner['first_name'] or f"ID{owner['telegram_id']}"
-                        owner_text = f" (владелец: @{owner_name})"
-                    
-                    search_text += f"👤 @{name} - {prisoner['price']} монет{owner_text}\n"
-                
-                await update.message.reply_text(
-                    search_text,
-                    reply_markup=get_search_results_keyboard(prisoners, None, search_term),
-                    parse_mode='HTML'
-                )
-            return
+            context.user_data['state'] = "waiting_transfer_target"
+            context.user_data['transfer_amount'] = amount
+            await update.message.reply_text(
+                f"💰 Сумма: {amount} монет\n"
+                "👤 Теперь введите @username или ID получателя:"
+            )
+        except ValueError:
+            await update.message.reply_text("Введите корректную сумму (число)!")
+    
+    elif state == "waiting_transfer_target":
+        amount = context.user_data['transfer_amount']
+        target_input = text.strip()
         
-        elif state == "waiting_transfer_amount":
+        # Try to find target user
+        target_user = None
+        if target_input.startswith("@"):
+            username = target_input[1:]
+            target_user = await run_db(get_user_by_username, username)
+        else:
             try:
-                amount = int(text)
-                if amount <= 0:
-                    await update.message.reply_text("Сумма должна быть положительной!")
-                    return
-                
-                user_states[user_id] = f"waiting_transfer_target_{amount}"
-                await update.message.reply_text(
-                    f"💰 Сумма: {amount} монет\n"
-                    "👤 Теперь введите @username или ID получателя:"
-                )
+                target_user_id = int(target_input)
+                target_user = await run_db(get_user, target_user_id)
             except ValueError:
-                await update.message.reply_text("Введите корректную сумму (число)!")
+                pass
         
-        elif state.startswith("waiting_transfer_target_"):
-            amount = int(state.split("_")[3])
-            target_input = text.strip()
-            
-            # Try to find target user
-            target_user = None
-            if target_input.startswith("@"):
-                username = target_input[1:]
-                from database import get_db_connection
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-                row = cursor.fetchone()
-                if row:
-                    target_user = dict(row)
-            else:
-                try:
-                    target_user_id = int(target_input)
-                    target_user = get_user(target_user_id)
-                except ValueError:
-                    pass
-            
-            if not target_user:
-                await update.message.reply_text("Пользователь не найден! Попробуйте еще раз.")
-                return
-            
-            if target_user['telegram_id'] == user_id:
-                await update.message.reply_text("Нельзя переводить самому себе!")
-                return
-            
-            # Perform transfer
-            success, message = transfer_money(user_id, target_user['telegram_id'], amount)
+        if not target_user:
             await update.message.reply_text(
-                message,
-                reply_markup=get_main_menu()
+                "Пользователь не найден или это имя носят несколько игроков! Попробуйте еще раз или введите ID."
             )
+            return
+        
+        if target_user['telegram_id'] == user_id:
+            await update.message.reply_text("Нельзя переводить самому себе!")
+            return
+        
+        # Perform transfer
+        success, message, sender_new, recipient_new = await run_db(
+            transfer_money, user_id, target_user['telegram_id'], amount
+        )
+        await update.message.reply_text(
+            message,
+            reply_markup=get_main_menu()
+        )
+        
+        # Send notification to recipient if transfer was successful
+        if success:
+            sender = update.effective_user
+            sender_name = display_name(sender)
             
-            # Send notification to recipient if transfer was successful
-            if success:
-                sender_user = get_user(user_id)
-                recipient_user = get_user(target_user['telegram_id'])
-                sender_name = sender_user['username'] or sender_user['first_name'] or f"ID{user_id}"
-                
-                notification_text = TRANSFER_RECEIVED_MESSAGE.format(
-                    sender=sender_name,
-                    amount=amount,
-                    new_balance=recipient_user['balance']
-                )
-                await send_notification(target_user['telegram_id'], notification_text)
-            
-            del user_states[user_id]
+            notification_text = TRANSFER_RECEIVED_MESSAGE.format(
+                sender=sender_name,
+                amount=amount,
+                new_balance=recipient_new
+            )
+            await send_notification(target_user['telegram_id'], notification_text)
+        
+        context.user_data.pop('state', None)
+        context.user_data.pop('transfer_amount', None)
     
     # Check for admin commands (only for @ceosulim)
     elif update.effective_user.username == 'ceosulim' and text.startswith('/'):
         await handle_admin_command(update, context)
-    elif update.effective_user.username == 'ceosulim' and text.split()[0].lower() in ['addcoins', 'setcoins', 'setpoints']:
+    elif update.effective_user.username == 'ceosulim' and text.lower().startswith(ADMIN_TEXT_COMMANDS):
         await handle_admin_text_command(update, context)
     else:
         # Default response
@@ -368,14 +392,16 @@ async def show_main_menu(query):
     """Show main menu"""
     await query.edit_message_text(
         MAIN_MENU_MESSAGE,
-        reply_markup=get_main_menu(),
-        parse_mode='HTML'
+        reply_markup=get_main_menu()
     )
 
 async def show_my_profile(query):
     """Show user's profile"""
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user, prisoners = await asyncio.gather(
+        run_db(get_user, user_id),
+        run_db(get_my_prisoners, user_id)
+    )
     
     if not user:
         await query.edit_message_text("Ошибка: профиль не найден!")
@@ -384,18 +410,17 @@ async def show_my_profile(query):
     # Get owner info
     owner_info = ""
     if user['owner_id']:
-        owner = get_user(user['owner_id'])
-        owner_name = owner['username'] or owner['first_name'] or f"ID{owner['telegram_id']}"
+        owner = await run_db(get_user, user['owner_id'])
+        owner_name = display_name(owner)
         owner_info = f"🧑‍💼 Владелец: @{owner_name}"
     else:
         owner_info = "🆓 Свободен"
     
     # Get prisoner count
-    prisoners = get_my_prisoners(user_id)
     prisoner_count = len(prisoners)
     
     profile_text = PROFILE_MESSAGE.format(
-        username=user['username'] or user['first_name'] or f"ID{user_id}",
+        username=display_name(user, user_id),
         balance=user['balance'],
         points=round(user['points'], 2),
         price=user['price'],
@@ -405,14 +430,13 @@ async def show_my_profile(query):
     
     await query.edit_message_text(
         profile_text,
-        reply_markup=get_profile_keyboard(),
-        parse_mode='HTML'
+        reply_markup=get_profile_keyboard()
     )
 
-async def show_invite_link(query, context):
+async def show_invite_link(query, context=None):
     """Show referral invite link"""
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user = await run_db(get_user, user_id)
     
     if not user:
         await query.edit_message_text(
@@ -427,14 +451,13 @@ async def show_invite_link(query, context):
     
     await query.edit_message_text(
         invite_text,
-        reply_markup=get_invite_keyboard(referral_link),
-        parse_mode='HTML'
+        reply_markup=get_invite_keyboard(referral_link)
     )
 
 async def show_my_prisoners(query):
     """Show user's prisoners"""
     user_id = query.from_user.id
-    prisoners = get_my_prisoners(user_id)
+    prisoners = await run_db(get_my_prisoners, user_id)
     
     if not prisoners:
         await query.edit_message_text(
@@ -444,18 +467,29 @@ async def show_my_prisoners(query):
         )
         return
     
-    prisoners_text = f"👥 Твои заключённые ({len(prisoners)}):\n\n"
-    
-    for prisoner in prisoners:
-        name = prisoner['username'] or prisoner['first_name'] or f"ID{prisoner['telegram_id']}"
-        prisoners_text += f"👤 @{name} - {prisoner['price']} монет\n"
+    lines = [f"👥 Твои заключённые ({len(prisoners)}):\n"]
+    lines.extend(f"👤 @{display_name(prisoner)} - {prisoner['price']} монет" for prisoner in prisoners)
+    prisoners_text = "\n".join(lines) + "\n"
     
     await query.edit_message_text(
         prisoners_text,
-        reply_markup=get_prisoners_keyboard(prisoners),
-        parse_mode='HTML'
+        reply_markup=get_prisoners_keyboard(prisoners)
     )
 
+def format_prisoners_for_sale(prisoners) -> str:
+    """Render prisoner lines with owner names joined in by the list queries"""
+    parts = []
+    for prisoner in prisoners:
+        name = display_name(prisoner)
+        owner_text = ""
+        if prisoner['owner_id']:
+            owner = {'username': prisoner['owner_username'], 'first_name': prisoner['owner_first_name']}
+            owner_name = display_name(owner, prisoner['owner_id'])
+            owner_text = f" (владелец: @{owner_name})"
+        
+        parts.append(f"👤 @{name} - {prisoner['price']} монет{owner_text}\n")
+    return "".join(parts)
+
 async def show_find_prisoner(query, sort_by=None, search_term=None):
     """Show prisoners to buy with sorting and search options"""
     user_id = query.from_user.id
@@ -465,17 +499,16 @@ async def show_find_prisoner(query, sort_by=None, search_term=None):
         await query.edit_message_text(
             "🔍 <b>Поиск заключённых</b>\n\n"
             "Выберите способ поиска:",
-            reply_markup=get_find_prisoner_menu_keyboard(),
-            parse_mode='HTML'
+            reply_markup=get_find_prisoner_menu_keyboard()
         )
         return
     
     # Get prisoners based on search/sort criteria
     if search_term:
-        prisoners = search_prisoners_by_username(search_term, user_id)
-        search_text = f"🔍 Результат поиска '{search_term}':\n\n"
+        prisoners = await run_db(search_prisoners_by_username, search_term, user_id)
+        search_text = f"🔍 Результат поиска '{html.escape(search_term)}':\n\n"
     else:
-        prisoners = get_sorted_prisoners(sort_by, user_id)
+        prisoners = await run_db(get_sorted_prisoners, sort_by, user_id)
         sort_names = {
             'price_asc': 'по цене (дешевые)',
             'price_desc': 'по цене (дорогие)',
@@ -490,25 +523,16 @@ async def show_find_prisoner(query, sort_by=None, search_term=None):
         )
         return
     
-    for prisoner in prisoners:
-        name = prisoner['username'] or prisoner['first_name'] or f"ID{prisoner['telegram_id']}"
-        owner_text = ""
-        if prisoner['owner_id']:
-            owner = get_user(prisoner['owner_id'])
-            owner_name = owner['username'] or owner['first_name'] or f"ID{owner['telegram_id']}"
-            owner_text = f" (владелец: @{owner_name})"
-        
-        search_text += f"👤 @{name} - {prisoner['price']} монет{owner_text}\n"
+    search_text += format_prisoners_for_sale(prisoners)
     
     await query.edit_message_text(
         search_text,
-        reply_markup=get_search_results_keyboard(prisoners, sort_by, search_term),
-        parse_mode='HTML'
+        reply_markup=get_search_results_keyboard(prisoners, sort_by, search_term)
     )
 
 async def show_prisoner_profile(query, prisoner_id):
     """Show detailed prisoner profile"""
-    prisoner = get_user(prisoner_id)
+    prisoner, shield_status, history = await run_db(get_prisoner_profile_bundle, prisoner_id)
     
     if not prisoner:
         await query.edit_message_text("Заключённый не найден!")
@@ -517,14 +541,13 @@ async def show_prisoner_profile(query, prisoner_id):
     # Get owner info
     owner_info = ""
     if prisoner['owner_id']:
-        owner = get_user(prisoner['owner_id'])
-        owner_name = owner['username'] or owner['first_name'] or f"ID{owner['telegram_id']}"
+        owner = {'username': prisoner['owner_username'], 'first_name': prisoner['owner_first_name']}
+        owner_name = display_name(owner, prisoner['owner_id'])
         owner_info = f"@{owner_name}"
     else:
         owner_info = "Свободен"
     
-    # Get ownership history
-    history = get_ownership_history(prisoner_id)
+    # Format ownership history
     history_text = "История: "
     if history:
         history_owners = []
@@ -537,10 +560,9 @@ async def show_prisoner_profile(query, prisoner_id):
     else:
         history_text += "Нет данных"
     
-    name = prisoner['username'] or prisoner['first_name'] or f"ID{prisoner_id}"
+    name = display_name(prisoner, prisoner_id)
     
-    # Check shield status
-    shield_status = check_shield_status(prisoner_id)
+    # Format shield status
     shield_text = ""
     if shield_status['has_shield']:
         shield_text = f"\n🛡️ Защищён щитом ({shield_status['time_left']} ч.)"
@@ -553,13 +575,15 @@ async def show_prisoner_profile(query, prisoner_id):
     ) + shield_text
     
     # Create keyboard with buy option if not owned by current user
-    from keyboards import get_prisoner_profile_keyboard
-    keyboard = get_prisoner_profile_keyboard(prisoner_id, query.from_user.id)
+    upgrade_cost = None
+    if prisoner['owner_id'] == query.from_user.id:
+        upgrade_info = await run_db(get_prisoner_upgrade_info, prisoner_id)
+        upgrade_cost = upgrade_info.next_cost
+    keyboard = get_prisoner_profile_keyboard(prisoner, query.from_user.id, upgrade_cost)
     
     await query.edit_message_text(
         profile_text,
-        reply_markup=keyboard,
-        parse_mode='HTML'
+        reply_markup=keyboard
     )
 
 async def buy_prisoner_action(query, prisoner_id):
@@ -569,7 +593,7 @@ async def buy_prisoner_action(query, prisoner_id):
     logger.info(f"Buy prisoner attempt: buyer_id={buyer_id}, prisoner_id={prisoner_id}")
     
     try:
-        success, message = buy_prisoner(buyer_id, prisoner_id)
+        success, message = await run_db(buy_prisoner, buyer_id, prisoner_id)
         
         logger.info(f"Buy prisoner result: success={success}, message={message}")
         
@@ -577,8 +601,7 @@ async def buy_prisoner_action(query, prisoner_id):
             # Show success message and return to main menu
             await query.edit_message_text(
                 f"✅ {message}",
-                reply_markup=get_main_menu(),
-                parse_mode='HTML'
+                reply_markup=get_main_menu()
             )
         else:
             # Show error message and allow user to try again
@@ -592,7 +615,7 @@ async def buy_prisoner_action(query, prisoner_id):
 async def show_balance_transfer(query):
     """Show balance and transfer options"""
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user = await run_db(get_user, user_id)
     
     balance_text = f"💰 Твой баланс: {user['balance']} монет\n\n" \
                    "Выбери действие:"
@@ -611,6 +634,16 @@ async def show_leaderboard_menu(query):
 
 async def show_leaderboard(query, category):
     """Show leaderboard for specific category"""
+    # get_leaderboard keeps the data for a minute; rendering it is cheap
+    leaderboard_text = await run_db(render_leaderboard, category)
+    
+    await query.edit_message_text(
+        leaderboard_text,
+        reply_markup=get_back_keyboard()
+    )
+
+def render_leaderboard(category: str) -> str:
+    """Build leaderboard text for a category"""
     leaders = get_leaderboard(category)
     
     if category == 'prisoners':
@@ -623,40 +656,35 @@ async def show_leaderboard(query, category):
         title = "🏆 Топ по стоимости заключённых:"
         format_func = lambda x: f"{x.get('total_value', 0)} монет"
     
-    leaderboard_text = f"{title}\n\n"
+    parts = [f"{title}\n\n"]
     
     for i, leader in enumerate(leaders, 1):
-        name = leader['username'] or leader['first_name'] or f"ID{leader['telegram_id']}"
+        name = display_name(leader)
         emoji = "👑" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-        leaderboard_text += f"{emoji} @{name} - {format_func(leader)}\n"
+        parts.append(f"{emoji} @{name} - {format_func(leader)}\n")
     
-    await query.edit_message_text(
-        leaderboard_text,
-        reply_markup=get_back_keyboard(),
-        parse_mode='HTML'
-    )
+    return "".join(parts)
 
 async def show_ownership_history(query, prisoner_id):
     """Show ownership history for prisoner"""
-    history = get_ownership_history(prisoner_id)
-    prisoner = get_user(prisoner_id)
+    prisoner, _, history = await run_db(get_prisoner_profile_bundle, prisoner_id)
     
-    name = prisoner['username'] or prisoner['first_name'] or f"ID{prisoner_id}"
+    name = display_name(prisoner) if prisoner else f"ID{prisoner_id}"
     
     if not history:
         history_text = f"📚 История владения @{name}:\n\nНет данных об истории."
     else:
-        history_text = f"📚 История владения @{name}:\n\n"
+        parts = [f"📚 История владения @{name}:\n\n"]
         for h in history:
             old_owner = h['old_owner_username'] or "Система"
             new_owner = h['new_owner_username'] or "Неизвестно"
             price_text = f" за {h['price']} монет" if h['price'] > 0 else ""
-            history_text += f"@{old_owner} ➝ @{new_owner}{price_text}\n"
+            parts.append(f"@{old_owner} ➝ @{new_owner}{price_text}\n")
+        history_text = "".join(parts)
     
     await query.edit_message_text(
         history_text,
-        reply_markup=get_back_keyboard(),
-        parse_mode='HTML'
+        reply_markup=get_back_keyboard()
     )
 
 async def show_prisoner_details(query, prisoner_id):
@@ -672,49 +700,37 @@ async def send_prisoners_to_work_action(query):
     """Handle sending prisoners to work"""
     user_id = query.from_user.id
     
-    success, message, workers_count = send_prisoners_to_work(user_id)
+    success, message, workers_count, prisoners = await run_db(send_prisoners_to_work, user_id)
     
-    if success:
-        # Refresh prisoners list to show updated status
-        prisoners = get_my_prisoners(user_id)
-        await query.edit_message_text(
-            message,
-            reply_markup=get_prisoners_keyboard(prisoners),
-            parse_mode='HTML'
-        )
-    else:
-        await query.edit_message_text(
-            message,
-            reply_markup=get_prisoners_keyboard(get_my_prisoners(user_id)),
-            parse_mode='HTML'
-        )
+    await query.edit_message_text(
+        message,
+        reply_markup=get_prisoners_keyboard(prisoners)
+    )
 
 async def collect_work_reward_action(query):
     """Handle collecting work rewards"""
     user_id = query.from_user.id
     
-    success, message, reward = collect_work_rewards(user_id)
+    success, message, reward, prisoners, new_balance = await run_db(collect_work_rewards, user_id)
     
     if success:
-        # Update user data and show new balance
-        user = get_user(user_id)
-        updated_message = message + f"\n\n💰 Текущий баланс: {user['balance']} монет"
+        updated_message = message + f"\n\n💰 Текущий баланс: {new_balance} монет"
     else:
         updated_message = message
     
-    # Refresh prisoners list
-    prisoners = get_my_prisoners(user_id)
     await query.edit_message_text(
         updated_message,
-        reply_markup=get_prisoners_keyboard(prisoners),
-        parse_mode='HTML'
+        reply_markup=get_prisoners_keyboard(prisoners)
     )
 
 async def show_work_status(query):
     """Show work status for user's prisoners"""
     user_id = query.from_user.id
     
-    status = get_work_status(user_id)
+    status, prisoners = await asyncio.gather(
+        run_db(get_work_status, user_id),
+        run_db(get_my_prisoners, user_id)
+    )
     
     if not status['has_active_jobs']:
         status_text = "🔴 Нет активных заданий\nОтправь заключённых на работу!"
@@ -732,11 +748,9 @@ async def show_work_status(query):
         status_text=status_text
     )
     
-    prisoners = get_my_prisoners(user_id)
     await query.edit_message_text(
         work_status_text,
-        reply_markup=get_prisoners_keyboard(prisoners),
-        parse_mode='HTML'
+        reply_markup=get_prisoners_keyboard(prisoners)
     )
 
 async def self_buyout_action(query, prisoner_id):
@@ -748,32 +762,23 @@ async def self_buyout_action(query, prisoner_id):
         await query.answer("❌ Ты можешь выкупить только свою свободу!", show_alert=True)
         return
     
-    success, message = buy_self_freedom(user_id)
+    success, message = await run_db(buy_self_freedom, user_id)
     
     if success:
         # Send notification to former owner
-        user = get_user(user_id)
+        user, former_owner_id = await asyncio.gather(
+            run_db(get_user, user_id),
+            run_db(get_last_self_buyout_owner, user_id)
+        )
         if user:
-            # Find former owner from transaction history
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT old_owner_id FROM ownership_history 
-                WHERE prisoner_id = ? AND new_owner_id IS NULL 
-                ORDER BY created_at DESC LIMIT 1
-            ''', (user_id,))
-            
-            former_owner_result = cursor.fetchone()
-            if former_owner_result:
-                former_owner_id = former_owner_result[0]
-                prisoner_name = user['username'] or user['first_name'] or f"ID{user_id}"
+            if former_owner_id:
+                prisoner_name = display_name(user, user_id)
                 notification_message = f"🆓 Твой заключённый @{prisoner_name} выкупил свою свободу!"
                 await send_notification(former_owner_id, notification_message)
         
         await query.edit_message_text(
             message,
-            reply_markup=get_main_menu(),
-            parse_mode='HTML'
+            reply_markup=get_main_menu()
         )
     else:
         await query.answer(message, show_alert=True)
@@ -782,15 +787,11 @@ async def activate_shield_action(query, prisoner_id):
     """Handle shield activation"""
     user_id = query.from_user.id
     
-    success, message = activate_shield(user_id, prisoner_id)
+    success, message = await run_db(activate_shield, user_id, prisoner_id)
     
     if success:
         # Send notification to prisoner about shield activation
-        prisoner = get_user(prisoner_id)
-        if prisoner:
-            prisoner_name = prisoner['username'] or prisoner['first_name'] or f"ID{prisoner_id}"
-            shield_message = f"🛡️ Твой владелец активировал защитный щит! Ты защищён на 24 часа."
-            await send_notification(prisoner_id, shield_message)
+        await send_notification(prisoner_id, "🛡️ Твой владелец активировал защитный щит! Ты защищён на 24 часа.")
         
         await query.answer("🛡️ Защитный щит активирован!", show_alert=True)
         # Refresh prisoner profile to show updated information
@@ -800,106 +801,71 @@ async def activate_shield_action(query, prisoner_id):
 
 async def show_price_analysis(query):
     """Show detailed price analysis for user"""
-    from game_logic import GameLogic
-    from database import get_db_connection
-    
     user_id = query.from_user.id
-    user = get_user(user_id)
+    stats = await run_db(get_price_analysis_bundle, user_id)
     
-    if not user:
+    if not stats:
         await query.edit_message_text(
             "Ошибка: профиль не найден!",
             reply_markup=get_back_keyboard()
         )
         return
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     # Calculate individual price factors
-    base_price = user['price']
-    liquidity_mult = GameLogic._calculate_liquidity_multiplier(user_id, cursor)
-    stability_mult = GameLogic._calculate_income_stability_multiplier(user_id, cursor)
-    empire_mult = GameLogic._calculate_empire_multiplier(user_id, cursor)
-    profit_mult = GameLogic._calculate_profit_multiplier(user_id, cursor)
-    
-    # Get trading statistics
-    cursor.execute('''
-        SELECT COUNT(*) as trades, AVG(price) as avg_price, MAX(price) as max_price
-        FROM ownership_history 
-        WHERE prisoner_id = ? AND timestamp > datetime('now', '-30 days')
-    ''', (user_id,))
-    trade_stats = cursor.fetchone()
-    
-    # Get income statistics  
-    cursor.execute('''
-        SELECT COUNT(*) as income_days, AVG(amount) as avg_income
-        FROM income_log 
-        WHERE user_id = ? AND timestamp > datetime('now', '-7 days')
-    ''', (user_id,))
-    income_stats = cursor.fetchone()
-    
-    # Get prisoner empire info with upgrades
-    from database import get_prisoner_upgrade_info, get_profit_statistics
-    
-    prisoners = get_my_prisoners(user_id)
-    prisoner_count = len(prisoners)
-    avg_prisoner_value = sum(p['price'] for p in prisoners) / prisoner_count if prisoner_count > 0 else 0
-    
-    # Calculate upgrade investments
-    total_upgrades = sum(get_prisoner_upgrade_info(p['telegram_id'])['total_invested'] for p in prisoners)
-    avg_upgrade_investment = total_upgrades / prisoner_count if prisoner_count > 0 else 0
-    
-    # Get profit stats
-    profit_stats = get_profit_statistics(user_id)
-    
-    analysis_text = f"""📊 <b>Анализ стоимости игрока</b>
-
-👤 <b>Текущая цена:</b> {base_price} монет
-
-🔍 <b>Факторы ценообразования:</b>
-
-📈 <b>История торговли (×{liquidity_mult:.2f}):</b>
-• Сделок за месяц: {trade_stats[0] if trade_stats else 0}
-• Средняя цена: {int(trade_stats[1]) if trade_stats and trade_stats[1] else 0} монет
-• Максимальная цена: {int(trade_stats[2]) if trade_stats and trade_stats[2] else 0} монет
-
-💰 <b>Стабильность дохода (×{stability_mult:.2f}):</b>
-• Дней с доходом: {income_stats[0] if income_stats else 0}
-• Средний доход: {int(income_stats[1]) if income_stats and income_stats[1] else 0} монет/день
-
-🏛️ <b>Империя заключённых (×{empire_mult:.2f}):</b>
-• Количество заключённых: {prisoner_count}
-• Средняя стоимость: {int(avg_prisoner_value)} монет
-• Вложено в улучшения: {int(avg_upgrade_investment)} монет
-
-💼 <b>Прибыльность (×{profit_mult:.2f}):</b>
-• Приносит прибыли: {profit_stats['avg_generated']} монет/день
-• Получает дохода: {profit_stats['avg_received']} монет/день
-• Чистая прибыль: {profit_stats['net_profit']} монет
-
-🎯 <b>Итоговый множитель:</b> ×{liquidity_mult * stability_mult * empire_mult * profit_mult:.2f}
-
-💡 <b>Как повысить цену:</b>
-• Покупайте и продавайте чаще (ликвидность)
-• Получайте стабильный доход каждый день
-• Собирайте и улучшайте дорогих заключённых
-• Увеличивайте прибыльность для владельца
-• Активно участвуйте в торговле"""
+    base_price = stats['price']
+    multipliers = GameLogic.calculate_price_multipliers(stats)
+    liquidity_mult = multipliers['liquidity']
+    stability_mult = multipliers['stability']
+    empire_mult = multipliers['empire']
+    profit_mult = multipliers['profit']
+    
+    total_mult = liquidity_mult * stability_mult * empire_mult * profit_mult
+    
+    trade_count = stats['trade_count']
+    avg_trade_price = int(stats['avg_trade_price'] or 0)
+    max_trade_price = int(stats['max_trade_price'] or 0)
+    income_count = stats['income_count']
+    avg_income = int(stats['avg_income'] or 0)
+    profit_stats = stats['profit']
+    avg_generated = profit_stats['avg_generated']
+    avg_received = profit_stats['avg_received']
+    net_profit = profit_stats['net_profit']
+    
+    # Prisoner empire info with upgrades
+    prisoner_count = stats['prisoner_count']
+    avg_prisoner_value = stats['prisoners_value'] / prisoner_count if prisoner_count > 0 else 0
+    avg_upgrade_investment = stats['upgrades_invested'] / prisoner_count if prisoner_count > 0 else 0
+    
+    analysis_text = PRICE_ANALYSIS_MESSAGE.format(
+        base_price=base_price,
+        liquidity_mult=liquidity_mult,
+        trade_count=trade_count,
+        avg_trade_price=avg_trade_price,
+        max_trade_price=max_trade_price,
+        stability_mult=stability_mult,
+        income_count=income_count,
+        avg_income=avg_income,
+        empire_mult=empire_mult,
+        prisoner_count=prisoner_count,
+        avg_prisoner_value=int(avg_prisoner_value),
+        avg_upgrade_investment=int(avg_upgrade_investment),
+        profit_mult=profit_mult,
+        avg_generated=avg_generated,
+        avg_received=avg_received,
+        net_profit=net_profit,
+        total_mult=total_mult
+    )
 
     await query.edit_message_text(
         analysis_text,
-        reply_markup=get_back_keyboard(),
-        parse_mode='HTML'
+        reply_markup=get_back_keyboard()
     )
 
 async def upgrade_prisoner_action(query, prisoner_id):
     """Handle prisoner upgrade action"""
-    from database import upgrade_prisoner
-    
     user_id = query.from_user.id
     
-    success, message = upgrade_prisoner(user_id, prisoner_id)
+    success, message = await run_db(upgrade_prisoner, user_id, prisoner_id)
     
     if success:
         await query.answer("🎯 Заключённый успешно улучшен!", show_alert=True)
@@ -921,34 +887,41 @@ async def handle_admin_command(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = update.effective_user.id
     
     if text == '/users':
-        users = admin_get_all_users()
+        # Show first 20 users
+        users, total_users = await asyncio.gather(
+            run_db(admin_get_users_page, 20),
+            run_db(admin_count_users)
+        )
         if not users:
             await update.message.reply_text("База данных пуста.")
             return
         
-        response = "👥 <b>Все пользователи:</b>\n\n"
-        for i, user in enumerate(users[:20]):  # Show first 20 users
-            name = user['username'] or user['first_name'] or f"ID{user['telegram_id']}"
-            response += f"{i+1}. @{name}\n"
-            response += f"   💰 Монеты: {user['balance']}\n"
-            response += f"   ⭐ Очки: {user['points']:.2f}\n"
-            response += f"   🏷️ Цена: {user['price']}\n"
-            response += f"   👥 Заключенных: {user['prisoner_count']}\n\n"
+        parts = ["👥 <b>Все пользователи:</b>\n\n"]
+        for i, user in enumerate(users):
+            name = display_name(user)
+            parts.append(
+                f"{i+1}. @{name}\n"
+                f"   💰 Монеты: {user['balance']}\n"
+                f"   ⭐ Очки: {user['points']:.2f}\n"
+                f"   🏷️ Цена: {user['price']}\n"
+                f"   👥 Заключенных: {user['prisoner_count']}\n\n"
+            )
         
-        if len(users) > 20:
-            response += f"... и еще {len(users) - 20} пользователей"
+        if total_users > len(users):
+            parts.append(f"... и еще {total_users - len(users)} пользователей")
+        response = "".join(parts)
         
-        await update.message.reply_text(response, parse_mode='HTML')
+        await update.message.reply_text(response)
     
     elif text.startswith('/user '):
         username = text[6:].strip().replace('@', '')
-        user = admin_get_user_by_username(username)
+        user = await run_db(admin_get_user_by_username, username)
         
         if not user:
-            await update.message.reply_text(f"Пользователь @{username} не найден.")
+            await update.message.reply_text(f"Пользователь @{username} не найден или это имя носят несколько игроков.")
             return
         
-        name = user['username'] or user['first_name'] or f"ID{user['telegram_id']}"
+        name = display_name(user)
         owner_name = user['owner_username'] or "Свободен"
         
         response = f"👤 <b>Информация о @{name}</b>\n\n"
@@ -960,7 +933,7 @@ async def handle_admin_command(update: Update, context: ContextTypes.DEFAULT_TYP
         response += f"👥 Заключенных: {user['prisoner_count']}\n"
         response += f"📅 Создан: {user['created_at'][:10]}"
         
-        await update.message.reply_text(response, parse_mode='HTML')
+        await update.message.reply_text(response)
 
 async def handle_admin_text_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle admin text commands"""
@@ -979,57 +952,109 @@ async def handle_admin_text_command(update: Update, context: ContextTypes.DEFAUL
     
     logger.info(f"Admin command received: {text}")
     
-    try:
-        parts = text.split()
-        if len(parts) < 3:
-            await update.message.reply_text("Неверный формат. Используйте: addcoins @username количество")
-            return
-        
-        command = parts[0].lower()
-        username = parts[1].replace('@', '')
-        
-        if command in ['addcoins', 'setcoins']:
-            amount = int(parts[2])
-            target_user = admin_get_user_by_username(username)
-            
-            if not target_user:
-                await update.message.reply_text(f"Пользователь @{username} не найден.")
-                return
-            
-            if command == 'addcoins':
-                success = admin_add_coins(target_user['telegram_id'], amount)
-                action = "добавлено"
-            else:
-                success = admin_set_coins(target_user['telegram_id'], amount)
-                action = "установлено"
-            
-            if success:
-                await update.message.reply_text(f"✅ Пользователю @{username} {action} {amount} монет.")
-            else:
-                await update.message.reply_text("❌ Ошибка при изменении баланса.")
-        
-        elif command == 'setpoints':
-            amount = float(parts[2])
-            target_user = admin_get_user_by_username(username)
-            
-            if not target_user:
-                await update.message.reply_text(f"Пользователь @{username} не найден.")
-                return
-            
-            success = admin_set_points(target_user['telegram_id'], amount)
-            
-            if success:
-                await update.message.reply_text(f"✅ Пользователю @{username} установлено {amount} очков.")
-            else:
-                await update.message.reply_text("❌ Ошибка при изменении очков.")
-        
-        else:
-            await update.message.reply_text("Неизвестная команда. Доступны: addcoins, setcoins, setpoints")
+    match = ADMIN_TEXT_COMMAND_RE.match(text)
+    if not match:
+        await update.message.reply_text("Неверный формат. Используйте: addcoins @username количество")
+        context.user_data.pop('state', None)
+        return
+    
+    command, username, amount = match.groups()
     
-    except (ValueError, IndexError) as e:
+    try:
+        await ADMIN_TEXT_ACTIONS[command.lower()](update, username, amount)
+    except ValueError as e:
         logger.error(f"Error parsing admin command: {e}")
         await update.message.reply_text("Неверный формат команды.")
     
     # Clear admin state
-    if user_id in user_states:
-        del user_states[user_id]
+    context.user_data.pop('state', None)
+
+async def admin_add_coins_text(update: Update, username: str, amount: str):
+    """Handle 'addcoins @username amount'"""
+    amount = int(amount)
+    target_user = await run_db(admin_add_coins_by_username, username, amount)
+    
+    if not target_user:
+        await update.message.reply_text(f"Пользователь @{username} не найден или это имя носят несколько игроков.")
+        return
+    
+    await update.message.reply_text(
+        f"✅ Пользователю @{username} добавлено {amount} монет. Баланс: {target_user['balance']} монет."
+    )
+
+async def admin_set_coins_text(update: Update, username: str, amount: str):
+    """Handle 'setcoins @username amount'"""
+    amount = int(amount)
+    target_user = await run_db(admin_set_coins_by_username, username, amount)
+    
+    if not target_user:
+        await update.message.reply_text(f"Пользователь @{username} не найден или это имя носят несколько игроков.")
+        return
+    
+    await update.message.reply_text(
+        f"✅ Пользователю @{username} установлено {amount} монет. Баланс: {target_user['balance']} монет."
+    )
+
+async def admin_set_points_text(update: Update, username: str, amount: str):
+    """Handle 'setpoints @username amount'"""
+    amount = float(amount)
+    target_user = await run_db(admin_set_points_by_username, username, amount)
+    
+    if not target_user:
+        await update.message.reply_text(f"Пользователь @{username} не найден или это имя носят несколько игроков.")
+        return
+    
+    await update.message.reply_text(f"✅ Пользователю @{username} установлено {amount} очков.")
+
+# Callback data dispatch tables for button_handler
+CALLBACK_ACTIONS = {
+    "main_menu": show_main_menu,
+    "back": show_main_menu,
+    "my_profile": show_my_profile,
+    "invite_friend": show_invite_link,
+    "my_prisoners": show_my_prisoners,
+    "find_prisoner": show_find_prisoner,
+    "back_to_find": show_find_prisoner,
+    "refresh_search": show_find_prisoner,
+    "balance_transfer": show_balance_transfer,
+    "leaderboard": show_leaderboard_menu,
+    "send_to_work": send_prisoners_to_work_action,
+    "collect_work_reward": collect_work_reward_action,
+    "work_status": show_work_status,
+    "price_analysis": show_price_analysis,
+}
+
+# Buttons that start waiting for a text reply; they need the per-user context
+INPUT_ACTIONS = {
+    "search_by_username": start_username_search,
+    "transfer_money": start_money_transfer,
+}
+
+# Keyed by the one-character callback prefix; long names keep already sent buttons working
+PRISONER_ACTIONS = {
+    "v": show_prisoner_profile,
+    "b": buy_prisoner_action,
+    "h": show_ownership_history,
+    "s": self_buyout_action,
+    "S": activate_shield_action,
+    "u": upgrade_prisoner_action,
+    "view_profile": show_prisoner_profile,
+    "prisoner_profile": show_prisoner_profile,
+    "view_prisoner": show_prisoner_details,
+    "buy_prisoner": buy_prisoner_action,
+    "history": show_ownership_history,
+    "self_buyout": self_buyout_action,
+    "shield": activate_shield_action,
+    "upgrade": upgrade_prisoner_action,
+}
+
+ARGUMENT_ACTIONS = {
+    "sort": lambda query, sort_type: show_find_prisoner(query, sort_by=sort_type),
+    "leaderboard": show_leaderboard,
+}
+
+ADMIN_TEXT_ACTIONS = {
+    "addcoins": admin_add_coins_text,
+    "setcoins": admin_set_coins_text,
+    "setpoints": admin_set_points_text,
+}
@@ -0,0 +1,32 @@
+"""
+Pytest fixtures shared by the test scripts
+"""
+
+import pytest
+
+import database
+
+@pytest.fixture(scope='module', autouse=True)
+def scratch_database(tmp_path_factory):
+    """Run each test module against its own fresh database instead of the tracked durov_prison.db"""
+    saved_path = database.DATABASE_PATH
+    database.DATABASE_PATH = str(tmp_path_factory.mktemp('db') / 'durov_prison.db')
+    opened = len(database.all_connections)
+    
+    # Later connections open the scratch file; nothing cached may come from another database
+    if hasattr(database.local_data, 'connection'):
+        del database.local_data.connection
+    for cache in (database.user_cache, database.leaderboard_cache, database.upgrade_info_cache,
+                  database.profit_stats_cache, database.user_ids_cache):
+        cache.clear()
+    database.init_database()
+    
+    yield
+    
+    # Close every connection opened against the scratch file, worker threads' included
+    for conn in database.all_connections[opened:]:
+        conn.close()
+    del database.all_connections[opened:]
+    if hasattr(database.local_data, 'connection'):
+        del database.local_data.connection
+    database.DATABASE_PATH = saved_path
@@ -5,22 +5,167 @@ Handles all database operations including user management, transactions, and own
 
 import sqlite3
 import logging
-from datetime import datetime
-from typing import List, Dict, Optional, Tuple
+import functools
+import itertools
+import random
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, NamedTuple, Optional, Tuple
 import threading
+import atexit
+from cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# SQLite file every new connection opens
+DATABASE_PATH = 'durov_prison.db'
+
 # Thread-local storage for database connections
 local_data = threading.local()
 
+# Every connection opened, so planner statistics can be refreshed from each one at exit
+all_connections = []
+
+# Short-lived get_user results; handlers read the same rows several times per update.
+# Every write to users drops its entries, so the TTL only bounds staleness for outside edits
+user_cache = TTLCache(maxsize=4096, ttl=5.0)
+
+# Leaderboards are the same for everyone and may lag by up to a minute
+leaderboard_cache = TTLCache(maxsize=8, ttl=60.0)
+
+# Analysis screens are re-opened in quick succession; writers drop their entries
+upgrade_info_cache = TTLCache(maxsize=4096, ttl=30.0)
+profit_stats_cache = TTLCache(maxsize=4096, ttl=30.0)
+
+# All user IDs, sampled in Python for the random prisoner lists instead of ORDER BY RANDOM()
+user_ids_cache = TTLCache(maxsize=1, ttl=30.0)
+
+class UpgradeInfo(NamedTuple):
+    """Upgrade state of a prisoner; immutable, so cached instances are shared"""
+    level: int
+    multiplier: float
+    next_cost: int
+    total_invested: int
+
+# Prisoners that were never upgraded have no prisoner_upgrades record
+DEFAULT_UPGRADE_INFO = UpgradeInfo(level=1, multiplier=1.0, next_cost=100, total_invested=0)
+
+# Refresh planner statistics on a handler connection after this many write transactions;
+# the scheduled optimize only covers the tables the scheduler thread itself queries
+OPTIMIZE_EVERY_COMMITS = 1000
+transactional_commits = itertools.count(1)
+
+# Set by init_database once the users_fts trigram index is in place
+users_fts_enabled = False
+
+# Users whose shield_active flag is set, loaded by init_database (None until then).
+# Few users are shielded at any time, so most shield checks end at a set lookup
+active_shield_ids: Optional[set] = None
+
 def get_db_connection():
     """Get thread-local database connection"""
     if not hasattr(local_data, 'connection'):
-        local_data.connection = sqlite3.connect('durov_prison.db', check_same_thread=False)
+        # Every query text the bot issues stays compiled; the default cache holds only 128
+        local_data.connection = sqlite3.connect(DATABASE_PATH, check_same_thread=False,
+                                                cached_statements=512)
         local_data.connection.row_factory = sqlite3.Row
+        # WAL lets handler threads read while another thread writes
+        local_data.connection.execute('PRAGMA journal_mode=WAL')
+        local_data.connection.execute('PRAGMA synchronous=NORMAL')
+        local_data.connection.execute('PRAGMA temp_store=MEMORY')
+        # 16 MiB page cache per connection; there is one connection per DB worker thread
+        local_data.connection.execute('PRAGMA cache_size=-16384')
+        local_data.connection.execute('PRAGMA mmap_size=268435456')
+        # Bound the rows ANALYZE / PRAGMA optimize sample per index so they stay cheap on a large database
+        local_data.connection.execute('PRAGMA analysis_limit=400')
+        all_connections.append(local_data.connection)
     return local_data.connection
 
+def optimize_connection(conn: sqlite3.Connection):
+    """Let SQLite re-analyze the tables this connection queried whose statistics have gone stale"""
+    try:
+        conn.execute('PRAGMA optimize')
+    except sqlite3.Error as e:
+        logger.error(f"Error optimizing database connection: {e}")
+
+@atexit.register
+def optimize_connections():
+    """Optimize every connection, as recommended before closing"""
+    for conn in all_connections:
+        optimize_connection(conn)
+
+def transactional(func):
+    """Run a write helper inside BEGIN IMMEDIATE; the outermost call commits, or rolls back on error or a (False, ...) result"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        conn = get_db_connection()
+        
+        # Nested in another transactional helper: the outermost call ends the transaction
+        if getattr(local_data, 'after_commit', None) is not None:
+            return func(*args, **kwargs)
+        
+        # A transaction left open by a helper that never ended it is not ours to commit
+        if conn.in_transaction:
+            logger.warning(f"Rolling back a transaction left open before {func.__name__}")
+            conn.rollback()
+        
+        # Take the write lock before the first read so checks and writes see the same state
+        conn.execute('BEGIN IMMEDIATE')
+        local_data.after_commit = []
+        try:
+            result = func(*args, **kwargs)
+            if isinstance(result, tuple) and result and result[0] is False:
+                conn.rollback()
+                callbacks = []
+            else:
+                conn.commit()
+                callbacks = local_data.after_commit
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            local_data.after_commit = None
+        
+        for callback, callback_args in callbacks:
+            callback(*callback_args)
+        if next(transactional_commits) % OPTIMIZE_EVERY_COMMITS == 0:
+            optimize_connection(conn)
+        return result
+    return wrapper
+
+def after_commit(callback, *args):
+    """Run callback(*args) once the enclosing transactional helper has committed (cache and in-memory updates)"""
+    local_data.after_commit.append((callback, args))
+
+def timestamp_cutoff(days: int) -> str:
+    """UTC timestamp `days` ago, formatted like CURRENT_TIMESTAMP for range filters"""
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+def day_start_timestamp() -> str:
+    """Start of the current UTC day, formatted like CURRENT_TIMESTAMP so `timestamp >= ?` can use an index"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d 00:00:00')
+
+def shield_hours_left(shield_until: str) -> Optional[int]:
+    """Whole hours left on a shield ending at the stored UTC `shield_until`, None once it has expired"""
+    remaining = datetime.fromisoformat(shield_until) - datetime.now(timezone.utc).replace(tzinfo=None)
+    if remaining <= timedelta(0):
+        return None
+    return int(remaining.total_seconds() // 3600)
+
+def log_transactions(cursor: sqlite3.Cursor, entries: List[Tuple]):
+    """Log (from_user_id, to_user_id, amount, type, description) rows through one shared prepared statement"""
+    cursor.executemany('''
+        INSERT INTO transactions (from_user_id, to_user_id, amount, transaction_type, description)
+        VALUES (?, ?, ?, ?, ?)
+    ''', entries)
+
+def invalidate_user_caches(*telegram_ids: int):
+    """Drop memoized user lookups; call after any write to the users table (all users if no IDs given)"""
+    if telegram_ids:
+        for telegram_id in telegram_ids:
+            user_cache.pop(telegram_id)
+    else:
+        user_cache.clear()
+
 def reset_database():
     """Reset database - DROP ALL TABLES and recreate them"""
     conn = get_db_connection()
@@ -28,6 +173,7 @@ def reset_database():
     
     # Drop all tables
     tables_to_drop = [
+        'users_fts',
         'profit_log',
         'prisoner_upgrades', 
         'work_assignments',
@@ -49,131 +195,286 @@ def reset_database():
     
     # Reinitialize database with clean tables
     init_database()
+    invalidate_user_caches()
+    upgrade_info_cache.clear()
+    profit_stats_cache.clear()
+    user_ids_cache.clear()
     logger.info("Database reset completed - all data cleared")
 
-def init_database():
+# Tables and base indexes, applied in one script by init_database
+SCHEMA = '''
+BEGIN;
+
+-- Users table
+CREATE TABLE IF NOT EXISTS users (
+    telegram_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    balance INTEGER DEFAULT 300,
+    points REAL DEFAULT 0.0,
+    price INTEGER DEFAULT 100,
+    owner_id INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_income TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    referral_code TEXT UNIQUE,
+    shield_until TIMESTAMP,
+    shield_active BOOLEAN DEFAULT FALSE
+);
+
+-- Ownership history table
+CREATE TABLE IF NOT EXISTS ownership_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    prisoner_id INTEGER,
+    old_owner_id INTEGER,
+    new_owner_id INTEGER,
+    price INTEGER,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (prisoner_id) REFERENCES users (telegram_id),
+    FOREIGN KEY (old_owner_id) REFERENCES users (telegram_id),
+    FOREIGN KEY (new_owner_id) REFERENCES users (telegram_id)
+);
+
+-- Transactions table
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    from_user_id INTEGER,
+    to_user_id INTEGER,
+    amount INTEGER,
+    transaction_type TEXT,
+    description TEXT,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (from_user_id) REFERENCES users (telegram_id),
+    FOREIGN KEY (to_user_id) REFERENCES users (telegram_id)
+);
+
+-- Income log table
+CREATE TABLE IF NOT EXISTS income_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    amount INTEGER,
+    prisoner_count INTEGER,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (telegram_id)
+);
+
+-- Work assignments table for prisoners
+CREATE TABLE IF NOT EXISTS work_assignments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner_id INTEGER,
+    prisoner_id INTEGER,
+    start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    end_time TIMESTAMP,
+    status TEXT DEFAULT 'working',
+    expected_reward INTEGER,
+    completed BOOLEAN DEFAULT FALSE,
+    FOREIGN KEY (owner_id) REFERENCES users (telegram_id),
+    FOREIGN KEY (prisoner_id) REFERENCES users (telegram_id)
+);
+
+-- Prisoner upgrades table
+CREATE TABLE IF NOT EXISTS prisoner_upgrades (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    prisoner_id INTEGER,
+    upgrade_level INTEGER DEFAULT 1,
+    income_multiplier REAL DEFAULT 1.0,
+    upgrade_cost INTEGER DEFAULT 100,
+    total_invested INTEGER DEFAULT 0,
+    last_upgraded TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (prisoner_id) REFERENCES users (telegram_id)
+);
+
+-- Profit tracking table
+CREATE TABLE IF NOT EXISTS profit_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    profit_generated INTEGER DEFAULT 0,
+    profit_received INTEGER DEFAULT 0,
+    period_start TIMESTAMP,
+    period_end TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (telegram_id)
+);
+
+-- Telegram usernames are case-insensitive, so lookups compare with NOCASE
+CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE);
+
+-- Covering indexes for the per-user windows read by the price analysis
+CREATE INDEX IF NOT EXISTS idx_ownership_history_prisoner_ts ON ownership_history(prisoner_id, timestamp, price);
+CREATE INDEX IF NOT EXISTS idx_ownership_history_new_owner_ts ON ownership_history(new_owner_id, timestamp, price);
+CREATE INDEX IF NOT EXISTS idx_income_log_user_ts ON income_log(user_id, timestamp, amount);
+CREATE INDEX IF NOT EXISTS idx_profit_log_user_ts
+    ON profit_log(user_id, period_end, profit_generated, profit_received);
+
+-- Foreign-key style lookups: prisoners by owner, upgrades by prisoner, jobs by owner
+CREATE INDEX IF NOT EXISTS idx_users_owner ON users(owner_id);
+CREATE INDEX IF NOT EXISTS idx_prisoner_upgrades_prisoner ON prisoner_upgrades(prisoner_id, id);
+-- Only unfinished jobs are ever looked up, so the index skips the completed history
+DROP INDEX IF EXISTS idx_work_assignments_owner;
+CREATE INDEX IF NOT EXISTS idx_work_assignments_active ON work_assignments(owner_id, end_time) WHERE completed = FALSE;
+DROP INDEX IF EXISTS idx_transactions_to;
+CREATE INDEX IF NOT EXISTS idx_transactions_to_ts ON transactions(to_user_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_transactions_from_ts ON transactions(from_user_id, timestamp);
+
+COMMIT;
+'''
+
+def init_database(conn: sqlite3.Connection = None):
     """Initialize database with required tables"""
-    conn = get_db_connection()
+    conn = conn or get_db_connection()
     cursor = conn.cursor()
     
-    # Users table
+    # Tables and base indexes in one transaction
+    cursor.executescript(SCHEMA)
+    
+    # Add points column to existing users if it doesn't exist
+    try:
+        cursor.execute('ALTER TABLE users ADD COLUMN points REAL DEFAULT 0.0')
+        conn.commit()
+        logger.info("Added points column to users table")
+    except sqlite3.OperationalError:
+        # Column already exists
+        pass
+    
+    # Derived columns and the search index, each with the triggers that maintain them
+    init_owned_totals(cursor)
+    init_users_fts(cursor)
+    init_profit_log_day_index(cursor)
+    
+    conn.commit()
+    
+    global active_shield_ids
+    cursor.execute('SELECT telegram_id FROM users WHERE shield_active')
+    active_shield_ids = {row[0] for row in cursor.fetchall()}
+    
+    # Gather planner statistics once so the indexes above are costed properly; afterwards optimize keeps them fresh
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+    if cursor.fetchone() is None:
+        cursor.execute('ANALYZE')
+    else:
+        cursor.execute('PRAGMA optimize')
+    conn.commit()
+    logger.info("Database initialized successfully")
+
+def init_owned_totals(cursor: sqlite3.Cursor):
+    """Add the per-owner prisoner count and value columns and the triggers that maintain them"""
+    cursor.execute('PRAGMA table_info(users)')
+    columns = {row[1] for row in cursor.fetchall()}
+    
+    if 'owned_count' not in columns or 'owned_value' not in columns:
+        for column in ('owned_count', 'owned_value'):
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE users ADD COLUMN {column} INTEGER DEFAULT 0')
+        
+        # Backfill once from the current ownership
+        cursor.execute('''
+            UPDATE users SET
+                owned_count = (SELECT COUNT(*) FROM users p WHERE p.owner_id = users.telegram_id),
+                owned_value = (SELECT COALESCE(SUM(p.price), 0) FROM users p WHERE p.owner_id = users.telegram_id)
+        ''')
+        logger.info("Added owned_count/owned_value columns to users table")
+    
+    # Move a prisoner's count and price between owners whenever ownership or price changes
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            telegram_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            balance INTEGER DEFAULT 300,
-            points REAL DEFAULT 0.0,
-            price INTEGER DEFAULT 100,
-            owner_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_income TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            referral_code TEXT UNIQUE,
-            shield_until TIMESTAMP,
-            shield_active BOOLEAN DEFAULT FALSE
-        )
+        CREATE TRIGGER IF NOT EXISTS users_owned_insert AFTER INSERT ON users
+        WHEN new.owner_id IS NOT NULL BEGIN
+            UPDATE users SET owned_count = owned_count + 1, owned_value = owned_value + COALESCE(new.price, 0)
+            WHERE telegram_id = new.owner_id;
+        END
     ''')
-    
-    # Ownership history table
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS ownership_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            prisoner_id INTEGER,
-            old_owner_id INTEGER,
-            new_owner_id INTEGER,
-            price INTEGER,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (prisoner_id) REFERENCES users (telegram_id),
-            FOREIGN KEY (old_owner_id) REFERENCES users (telegram_id),
-            FOREIGN KEY (new_owner_id) REFERENCES users (telegram_id)
-        )
+        CREATE TRIGGER IF NOT EXISTS users_owned_update AFTER UPDATE OF owner_id, price ON users
+        WHEN old.owner_id IS NOT new.owner_id OR old.price IS NOT new.price BEGIN
+            UPDATE users SET owned_count = owned_count - 1, owned_value = owned_value - COALESCE(old.price, 0)
+            WHERE telegram_id = old.owner_id;
+            UPDATE users SET owned_count = owned_count + 1, owned_value = owned_value + COALESCE(new.price, 0)
+            WHERE telegram_id = new.owner_id;
+        END
     ''')
-    
-    # Transactions table
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            from_user_id INTEGER,
-            to_user_id INTEGER,
-            amount INTEGER,
-            transaction_type TEXT,
-            description TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (from_user_id) REFERENCES users (telegram_id),
-            FOREIGN KEY (to_user_id) REFERENCES users (telegram_id)
-        )
+        CREATE TRIGGER IF NOT EXISTS users_owned_delete AFTER DELETE ON users
+        WHEN old.owner_id IS NOT NULL BEGIN
+            UPDATE users SET owned_count = owned_count - 1, owned_value = owned_value - COALESCE(old.price, 0)
+            WHERE telegram_id = old.owner_id;
+        END
     ''')
     
-    # Income log table
+    # Leaderboards read the top of these directly
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_owned_count ON users(owned_count)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_owned_value ON users(owned_value)')
+
+def init_profit_log_day_index(cursor: sqlite3.Cursor):
+    """Make profit_log hold one record per user per day, so log_profit_data can upsert into it"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_profit_log_user_day'")
+    if cursor.fetchone() is not None:
+        return
+    
+    # Fold any same-day duplicates into the oldest record before enforcing uniqueness
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS income_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            amount INTEGER,
-            prisoner_count INTEGER,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (telegram_id)
-        )
+        UPDATE profit_log SET
+            profit_generated = (SELECT SUM(d.profit_generated) FROM profit_log d
+                                WHERE d.user_id = profit_log.user_id AND DATE(d.period_end) = DATE(profit_log.period_end)),
+            profit_received = (SELECT SUM(d.profit_received) FROM profit_log d
+                               WHERE d.user_id = profit_log.user_id AND DATE(d.period_end) = DATE(profit_log.period_end))
+        WHERE id IN (SELECT MIN(id) FROM profit_log GROUP BY user_id, DATE(period_end) HAVING COUNT(*) > 1)
     ''')
-    
-    # Work assignments table for prisoners
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS work_assignments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            owner_id INTEGER,
-            prisoner_id INTEGER,
-            start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            end_time TIMESTAMP,
-            status TEXT DEFAULT 'working',
-            expected_reward INTEGER,
-            completed BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (owner_id) REFERENCES users (telegram_id),
-            FOREIGN KEY (prisoner_id) REFERENCES users (telegram_id)
-        )
+        DELETE FROM profit_log
+        WHERE id NOT IN (SELECT MIN(id) FROM profit_log GROUP BY user_id, DATE(period_end))
     ''')
+    cursor.execute('CREATE UNIQUE INDEX idx_profit_log_user_day ON profit_log(user_id, DATE(period_end))')
+
+def init_users_fts(cursor: sqlite3.Cursor):
+    """Create the trigram index over usernames used by the prisoner search"""
+    global users_fts_enabled
+    
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_fts'")
+    is_new = cursor.fetchone() is None
+    
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                username, first_name, content='users', content_rowid='telegram_id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5 (or older than 3.34): search falls back to LIKE
+        logger.warning(f"Username search index unavailable: {e}")
+        users_fts_enabled = False
+        return
     
-    # Prisoner upgrades table
+    # Keep the external-content index in step with users
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS prisoner_upgrades (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            prisoner_id INTEGER,
-            upgrade_level INTEGER DEFAULT 1,
-            income_multiplier REAL DEFAULT 1.0,
-            upgrade_cost INTEGER DEFAULT 100,
-            total_invested INTEGER DEFAULT 0,
-            last_upgraded TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (prisoner_id) REFERENCES users (telegram_id)
-        )
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts(rowid, username, first_name)
+            VALUES (new.telegram_id, new.username, new.first_name);
+        END
     ''')
-    
-    # Profit tracking table
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS profit_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            profit_generated INTEGER DEFAULT 0,
-            profit_received INTEGER DEFAULT 0,
-            period_start TIMESTAMP,
-            period_end TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (telegram_id)
-        )
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts(users_fts, rowid, username, first_name)
+            VALUES ('delete', old.telegram_id, old.username, old.first_name);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, first_name ON users BEGIN
+            INSERT INTO users_fts(users_fts, rowid, username, first_name)
+            VALUES ('delete', old.telegram_id, old.username, old.first_name);
+            INSERT INTO users_fts(rowid, username, first_name)
+            VALUES (new.telegram_id, new.username, new.first_name);
+        END
     ''')
     
-    # Add points column to existing users if it doesn't exist
-    try:
-        cursor.execute('ALTER TABLE users ADD COLUMN points REAL DEFAULT 0.0')
-        conn.commit()
-        logger.info("Added points column to users table")
-    except sqlite3.OperationalError:
-        # Column already exists
-        pass
+    if is_new:
+        cursor.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+        logger.info("Built username search index")
     
-    conn.commit()
-    logger.info("Database initialized successfully")
+    users_fts_enabled = True
 
-def create_user(telegram_id: int, username: str = None, first_name: str = None, referrer_id: int = None) -> bool:
+def create_user(telegram_id: int, username: str = None, first_name: str = None, referrer_id: int = None,
+                conn: sqlite3.Connection = None) -> bool:
     """Create a new user in the database"""
-    conn = get_db_connection()
+    # A caller-supplied connection means the caller owns the transaction
+    owns_transaction = conn is None
+    conn = conn or get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -199,16 +500,25 @@ def create_user(telegram_id: int, username: str = None, first_name: str = None,
             
             logger.info(f"User {telegram_id} captured by referrer {referrer_id}")
         
-        conn.commit()
+        if owns_transaction:
+            conn.commit()
+        invalidate_user_caches(telegram_id)
+        user_ids_cache.clear()
         logger.info(f"Created new user: {telegram_id} (@{username})")
         return True
         
     except sqlite3.IntegrityError:
+        if owns_transaction:
+            conn.rollback()
         logger.warning(f"User {telegram_id} already exists")
         return False
 
 def get_user(telegram_id: int) -> Optional[Dict]:
     """Get user information by telegram ID"""
+    cached = user_cache.get(telegram_id)
+    if cached is not None:
+        return dict(cached)
+    
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -216,9 +526,16 @@ def get_user(telegram_id: int) -> Optional[Dict]:
     row = cursor.fetchone()
     
     if row:
+        user_cache.set(telegram_id, dict(row))
         return dict(row)
     return None
 
+def display_name(user, user_id: int = None) -> str:
+    """Username, first name or ID placeholder for a users row (dict or sqlite3.Row) or a Telegram user"""
+    if isinstance(user, (dict, sqlite3.Row)):
+        return user['username'] or user['first_name'] or f"ID{user_id or user['telegram_id']}"
+    return user.username or user.first_name or f"ID{user.id}"
+
 def update_user_balance(telegram_id: int, amount: int) -> bool:
     """Update user balance (can be positive or negative)"""
     conn = get_db_connection()
@@ -229,6 +546,7 @@ def update_user_balance(telegram_id: int, amount: int) -> bool:
     ''', (amount, telegram_id))
     
     conn.commit()
+    invalidate_user_caches(telegram_id)
     return cursor.rowcount > 0
 
 def update_user_points(telegram_id: int, amount: float) -> bool:
@@ -241,19 +559,16 @@ def update_user_points(telegram_id: int, amount: float) -> bool:
     ''', (amount, telegram_id))
     
     conn.commit()
+    invalidate_user_caches(telegram_id)
     return cursor.rowcount > 0
 
 def add_referral_points(user_id: int) -> bool:
     """Add 1 point for successful referral"""
     return update_user_points(user_id, 1.0)
 
-def add_purchase_points(user_id: int, purchase_price: int) -> bool:
-    """Add 0.01% of purchase price as points"""
-    points_earned = purchase_price * 0.0001  # 0.01% = 0.0001
-    return update_user_points(user_id, points_earned)
-
-def transfer_money(from_user_id: int, to_user_id: int, amount: int) -> Tuple[bool, str]:
-    """Transfer money between users"""
+@transactional
+def transfer_money(from_user_id: int, to_user_id: int, amount: int) -> Tuple[bool, str, Optional[int], Optional[int]]:
+    """Transfer money between users, returns the sender's and recipient's new balances"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -262,27 +577,26 @@ def transfer_money(from_user_id: int, to_user_id: int, amount: int) -> Tuple[boo
     sender_balance = cursor.fetchone()
     
     if not sender_balance or sender_balance[0] < amount:
-        return False, "Недостаточно монет для перевода! 💸"
+        return False, "Недостаточно монет для перевода! 💸", None, None
     
     # Perform transfer
-    cursor.execute('UPDATE users SET balance = balance - ? WHERE telegram_id = ?', (amount, from_user_id))
-    cursor.execute('UPDATE users SET balance = balance + ? WHERE telegram_id = ?', (amount, to_user_id))
+    cursor.execute('UPDATE users SET balance = balance - ? WHERE telegram_id = ? RETURNING balance',
+                   (amount, from_user_id))
+    sender_new = cursor.fetchone()[0]
+    cursor.execute('UPDATE users SET balance = balance + ? WHERE telegram_id = ? RETURNING balance',
+                   (amount, to_user_id))
+    recipient_row = cursor.fetchone()
     
-    # Log transaction
-    cursor.execute('''
-        INSERT INTO transactions (from_user_id, to_user_id, amount, transaction_type, description)
-        VALUES (?, ?, ?, 'transfer', 'Перевод между игроками')
-    ''', (from_user_id, to_user_id, amount))
+    if not recipient_row:
+        return False, "Получатель не найден! 🔍", None, None
     
-    conn.commit()
-    return True, f"Перевод {amount} монет выполнен успешно! 💰"
+    # Log transaction
+    log_transactions(cursor, [(from_user_id, to_user_id, amount, 'transfer', 'Перевод между игроками')])
+    after_commit(invalidate_user_caches, from_user_id, to_user_id)
+    return True, f"Перевод {amount} монет выполнен успешно! 💰", sender_new, recipient_row[0]
 
 def buy_prisoner(buyer_id: int, prisoner_id: int) -> Tuple[bool, str]:
     """Buy a prisoner from their current owner"""
-    from game_logic import GameLogic
-    import logging
-    
-    logger = logging.getLogger(__name__)
     logger.info(f"Starting buy_prisoner: buyer={buyer_id}, prisoner={prisoner_id}")
     
     conn = get_db_connection()
@@ -315,8 +629,6 @@ def buy_prisoner(buyer_id: int, prisoner_id: int) -> Tuple[bool, str]:
     if buyer['balance'] < price:
         return False, f"Недостаточно монет! Нужно {price} монет. 💸"
     
-    old_owner_id = prisoner['owner_id']
-    
     # Calculate new dynamic price after purchase
     base_new_price = int(price * 1.3)  # Basic 30% increase
     
@@ -327,17 +639,16 @@ def buy_prisoner(buyer_id: int, prisoner_id: int) -> Tuple[bool, str]:
         
         # Get trading activity for this prisoner
         cursor.execute('''
-            SELECT COUNT(*) FROM ownership_history 
-            WHERE prisoner_id = ? AND timestamp > datetime('now', '-30 days')
-        ''', (prisoner_id,))
+            SELECT COUNT(*) FROM ownership_history
+            WHERE prisoner_id = ? AND timestamp > ?
+        ''', (prisoner_id, timestamp_cutoff(30)))
         recent_trades = cursor.fetchone()[0]
         
         if recent_trades >= 3:
             dynamic_multiplier += 0.1  # Active trading increases future price more
         
         # Check prisoner's empire value if they own others
-        prisoners_owned = get_my_prisoners(prisoner_id)
-        if len(prisoners_owned) >= 5:
+        if prisoner['owned_count'] >= 5:
             dynamic_multiplier += 0.15  # Valuable prisoners cost more
         
         new_price = int(base_new_price * dynamic_multiplier)
@@ -345,49 +656,70 @@ def buy_prisoner(buyer_id: int, prisoner_id: int) -> Tuple[bool, str]:
         logger.error(f"Error calculating dynamic price: {e}")
         new_price = base_new_price
     
+    return _complete_purchase(buyer_id, prisoner, new_price)
+
+@transactional
+def _complete_purchase(buyer_id: int, prisoner: Dict, new_price: int) -> Tuple[bool, str]:
+    """Write phase of buy_prisoner: move the prisoner checked by the caller to the buyer at new_price"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    prisoner_id = prisoner['telegram_id']
+    old_owner_id = prisoner['owner_id']
+    price = prisoner['price']
+    
+    # Points for the buyer (0.01% of purchase price)
+    points_earned = price * 0.0001
+    
+    # Re-read the prisoner under the write lock; the caller checked a cached copy
+    cursor.execute('''
+        SELECT owner_id, price, shield_active, shield_until FROM users WHERE telegram_id = ?
+    ''', (prisoner_id,))
+    row = cursor.fetchone()
+    
+    # Someone else bought the prisoner or the price changed meanwhile
+    if not row or row[0] != old_owner_id or row[1] != price:
+        return False, "Цена или владелец заключённого изменились, попробуй ещё раз! 🔄"
+    
+    # A shield activated after the caller's check still protects the prisoner
+    _, _, shield_active, shield_until = row
+    if shield_active and shield_until:
+        hours_left = shield_hours_left(shield_until)
+        if hours_left is not None:
+            return False, f"🛡️ Этот заключённый защищён щитом! Осталось {hours_left} часов до истечения защиты."
+    
     # Transfer ownership
     cursor.execute('''
         UPDATE users SET owner_id = ?, price = ? WHERE telegram_id = ?
     ''', (buyer_id, new_price, prisoner_id))
     
-    # Update buyer's balance
+    # Charge the buyer (with purchase points) and pay the previous owner in one statement
     cursor.execute('''
-        UPDATE users SET balance = balance - ? WHERE telegram_id = ?
-    ''', (price, buyer_id))
+        UPDATE users SET
+            balance = balance + CASE telegram_id WHEN ? THEN -? ELSE ? END,
+            points = points + CASE telegram_id WHEN ? THEN ? ELSE 0 END
+        WHERE telegram_id IN (?, ?) AND (telegram_id != ? OR balance >= ?)
+    ''', (buyer_id, price, price, buyer_id, points_earned, buyer_id, old_owner_id, buyer_id, price))
+    if cursor.rowcount != (2 if old_owner_id else 1):
+        return False, f"Недостаточно монет! Нужно {price} монет. 💸"
     
-    # Pay previous owner if exists
+    # Log sale to the old owner and the purchase itself
+    transactions = [(buyer_id, prisoner_id, price, 'purchase', 'Покупка заключённого')]
     if old_owner_id:
-        cursor.execute('''
-            UPDATE users SET balance = balance + ? WHERE telegram_id = ?
-        ''', (price, old_owner_id))
-        
-        # Log transaction to old owner
-        cursor.execute('''
-            INSERT INTO transactions (from_user_id, to_user_id, amount, transaction_type, description)
-            VALUES (?, ?, ?, 'sale', 'Продажа заключённого')
-        ''', (buyer_id, old_owner_id, price))
-    
-    # Log purchase transaction
-    cursor.execute('''
-        INSERT INTO transactions (from_user_id, to_user_id, amount, transaction_type, description)
-        VALUES (?, ?, ?, 'purchase', 'Покупка заключённого')
-    ''', (buyer_id, prisoner_id, price))
+        transactions.insert(0, (buyer_id, old_owner_id, price, 'sale', 'Продажа заключённого'))
+    log_transactions(cursor, transactions)
     
     # Add to ownership history
     cursor.execute('''
         INSERT INTO ownership_history (prisoner_id, old_owner_id, new_owner_id, price)
         VALUES (?, ?, ?, ?)
     ''', (prisoner_id, old_owner_id, buyer_id, price))
-    
-    # Award points to buyer (0.01% of purchase price)
-    add_purchase_points(buyer_id, price)
-    
-    conn.commit()
+    after_commit(invalidate_user_caches, buyer_id, prisoner_id, old_owner_id)
     
     # Calculate points earned for display
-    points_earned = round(price * 0.0001, 4)
+    points_earned = round(points_earned, 4)
     
-    username = prisoner['username'] or prisoner['first_name'] or f"ID{prisoner_id}"
+    username = display_name(prisoner)
     return True, f"🎉 Ты купил @{username} за {price} монет! ⭐ Получено очков: {points_earned}. Теперь он твой заключённый!"
 
 def get_my_prisoners(owner_id: int) -> List[Dict]:
@@ -396,45 +728,42 @@ def get_my_prisoners(owner_id: int) -> List[Dict]:
     cursor = conn.cursor()
     
     cursor.execute('''
-        SELECT telegram_id, username, first_name, price, created_at
-        FROM users WHERE owner_id = ?
-        ORDER BY created_at DESC
+        SELECT p.telegram_id, p.username, p.first_name, p.price, p.created_at, p.owner_id,
+               o.username AS owner_username, o.first_name AS owner_first_name
+        FROM users p LEFT JOIN users o ON o.telegram_id = p.owner_id
+        WHERE p.owner_id = ?
+        ORDER BY p.created_at DESC
     ''', (owner_id,))
     
     return [dict(row) for row in cursor.fetchall()]
 
 def get_random_prisoners(count: int = 5, exclude_user_id: int = None) -> List[Dict]:
     """Get random prisoners that can be bought"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    ids = get_all_user_ids()
+    picks = [i for i in random.sample(ids, min(len(ids), count + 1)) if i != exclude_user_id][:count]
     
-    query = '''
-        SELECT telegram_id, username, first_name, price, owner_id
-        FROM users 
-        WHERE telegram_id != ? 
-        ORDER BY RANDOM() 
-        LIMIT ?
-    '''
-    
-    cursor.execute(query, (exclude_user_id or 0, count))
-    return [dict(row) for row in cursor.fetchall()]
+    prisoners = get_prisoners_by_ids(picks)
+    return [prisoners[i] for i in picks if i in prisoners]
 
 def get_sorted_prisoners(sort_by: str, exclude_user_id: int = None, count: int = 10) -> List[Dict]:
     """Get prisoners sorted by specified criteria"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     # Define sorting criteria
     order_clause = {
-        'price_asc': 'ORDER BY price ASC',
-        'price_desc': 'ORDER BY price DESC',
-        'random': 'ORDER BY RANDOM()'
-    }.get(sort_by, 'ORDER BY RANDOM()')
+        'price_asc': 'ORDER BY p.price ASC',
+        'price_desc': 'ORDER BY p.price DESC'
+    }.get(sort_by)
+    
+    if not order_clause:
+        return get_random_prisoners(count, exclude_user_id)
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
     
     query = f'''
-        SELECT telegram_id, username, first_name, price, owner_id
-        FROM users 
-        WHERE telegram_id != ? 
+        SELECT p.telegram_id, p.username, p.first_name, p.price, p.owner_id,
+               o.username AS owner_username, o.first_name AS owner_first_name
+        FROM users p LEFT JOIN users o ON o.telegram_id = p.owner_id
+        WHERE p.telegram_id != ? 
         {order_clause}
         LIMIT ?
     '''
@@ -442,17 +771,59 @@ def get_sorted_prisoners(sort_by: str, exclude_user_id: int = None, count: int =
     cursor.execute(query, (exclude_user_id or 0, count))
     return [dict(row) for row in cursor.fetchall()]
 
+def get_all_user_ids() -> List[int]:
+    """Get all user IDs (cached for 30 seconds)"""
+    ids = user_ids_cache.get('all')
+    if ids is None:
+        conn = get_db_connection()
+        ids = [row[0] for row in conn.execute('SELECT telegram_id FROM users')]
+        user_ids_cache.set('all', ids)
+    return ids
+
+def get_prisoners_by_ids(telegram_ids: List[int]) -> Dict[int, Dict]:
+    """Get prisoner list rows with owner names for the given IDs, keyed by telegram ID"""
+    if not telegram_ids:
+        return {}
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    placeholders = ','.join('?' * len(telegram_ids))
+    cursor.execute(f'''
+        SELECT p.telegram_id, p.username, p.first_name, p.price, p.owner_id,
+               o.username AS owner_username, o.first_name AS owner_first_name
+        FROM users p LEFT JOIN users o ON o.telegram_id = p.owner_id
+        WHERE p.telegram_id IN ({placeholders})
+    ''', tuple(telegram_ids))
+    
+    return {row['telegram_id']: dict(row) for row in cursor.fetchall()}
+
 def search_prisoners_by_username(search_term: str, exclude_user_id: int = None) -> List[Dict]:
     """Search for prisoners by username or first name"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
+    # Trigrams need at least three characters; shorter terms still scan with LIKE
+    if users_fts_enabled and len(search_term) >= 3:
+        cursor.execute('''
+            SELECT p.telegram_id, p.username, p.first_name, p.price, p.owner_id,
+                   o.username AS owner_username, o.first_name AS owner_first_name
+            FROM users_fts f
+            JOIN users p ON p.telegram_id = f.rowid
+            LEFT JOIN users o ON o.telegram_id = p.owner_id
+            WHERE users_fts MATCH ? AND p.telegram_id != ?
+            ORDER BY p.price ASC
+            LIMIT 10
+        ''', ('"' + search_term.replace('"', '""') + '"', exclude_user_id or 0))
+        return [dict(row) for row in cursor.fetchall()]
+    
     query = '''
-        SELECT telegram_id, username, first_name, price, owner_id
-        FROM users 
-        WHERE telegram_id != ? 
-        AND (username LIKE ? OR first_name LIKE ?)
-        ORDER BY price ASC
+        SELECT p.telegram_id, p.username, p.first_name, p.price, p.owner_id,
+               o.username AS owner_username, o.first_name AS owner_first_name
+        FROM users p LEFT JOIN users o ON o.telegram_id = p.owner_id
+        WHERE p.telegram_id != ? 
+        AND (p.username LIKE ? OR p.first_name LIKE ?)
+        ORDER BY p.price ASC
         LIMIT 10
     '''
     
@@ -476,18 +847,63 @@ def get_ownership_history(prisoner_id: int) -> List[Dict]:
     
     return [dict(row) for row in cursor.fetchall()]
 
+def get_prisoner_profile_bundle(prisoner_id: int) -> Tuple[Optional[Dict], Dict, List[Dict]]:
+    """Get prisoner with owner name, shield status and ownership history in one call"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        SELECT u.*, o.username as owner_username, o.first_name as owner_first_name
+        FROM users u
+        LEFT JOIN users o ON o.telegram_id = u.owner_id
+        WHERE u.telegram_id = ?
+    ''', (prisoner_id,))
+    row = cursor.fetchone()
+    
+    if not row:
+        return None, {'has_shield': False, 'time_left': 0}, []
+    
+    prisoner = dict(row)
+    
+    # Same expiry check as check_shield_status
+    hours_left = None
+    if prisoner['shield_active'] and prisoner['shield_until']:
+        hours_left = shield_hours_left(prisoner['shield_until'])
+    if hours_left is not None:
+        shield = {'has_shield': True, 'time_left': hours_left}
+    else:
+        shield = {'has_shield': False, 'time_left': 0}
+    
+    return prisoner, shield, get_ownership_history(prisoner_id)
+
+def get_last_self_buyout_owner(prisoner_id: int) -> Optional[int]:
+    """Get the owner a prisoner most recently bought their freedom from"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        SELECT old_owner_id FROM ownership_history 
+        WHERE prisoner_id = ? AND new_owner_id IS NULL 
+        ORDER BY timestamp DESC, id DESC LIMIT 1
+    ''', (prisoner_id,))
+    
+    row = cursor.fetchone()
+    return row[0] if row else None
+
 def get_leaderboard(category: str = 'prisoners') -> List[Dict]:
-    """Get leaderboard data"""
+    """Get leaderboard data (cached for a minute)"""
+    cached = leaderboard_cache.get(category)
+    if cached is not None:
+        return [dict(leader) for leader in cached]
+    
     conn = get_db_connection()
     cursor = conn.cursor()
     
     if category == 'prisoners':
         cursor.execute('''
-            SELECT u.telegram_id, u.username, u.first_name, COUNT(p.telegram_id) as prisoner_count
-            FROM users u
-            LEFT JOIN users p ON u.telegram_id = p.owner_id
-            GROUP BY u.telegram_id
-            ORDER BY prisoner_count DESC
+            SELECT telegram_id, username, first_name, owned_count as prisoner_count
+            FROM users
+            ORDER BY owned_count DESC
             LIMIT 10
         ''')
     elif category == 'balance':
@@ -499,25 +915,26 @@ def get_leaderboard(category: str = 'prisoners') -> List[Dict]:
         ''')
     elif category == 'value':
         cursor.execute('''
-            SELECT u.telegram_id, u.username, u.first_name, 
-                   COALESCE(SUM(p.price), 0) as total_value
-            FROM users u
-            LEFT JOIN users p ON u.telegram_id = p.owner_id
-            GROUP BY u.telegram_id
-            ORDER BY total_value DESC
+            SELECT telegram_id, username, first_name, owned_value as total_value
+            FROM users
+            ORDER BY owned_value DESC
             LIMIT 10
         ''')
     
-    return [dict(row) for row in cursor.fetchall()]
+    leaders = [dict(row) for row in cursor.fetchall()]
+    leaderboard_cache.set(category, leaders)
+    return [dict(leader) for leader in leaders]
 
 def generate_hourly_income():
     """Generate hourly income for all users with prisoners (enhanced with upgrades)"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Get all users with their prisoners and upgrade info
+    # Get all users with their prisoners, upgrade info and the owner's own owner
     cursor.execute('''
-        SELECT u.telegram_id, p.telegram_id as prisoner_id, p.price
+        SELECT u.telegram_id, u.owner_id, p.telegram_id as prisoner_id, p.price,
+               COALESCE((SELECT pu.income_multiplier FROM prisoner_upgrades pu
+                         WHERE pu.prisoner_id = p.telegram_id ORDER BY pu.id LIMIT 1), 1.0) as income_multiplier
         FROM users u
         JOIN users p ON u.telegram_id = p.owner_id
         WHERE p.telegram_id IS NOT NULL
@@ -526,72 +943,115 @@ def generate_hourly_income():
     user_prisoners = cursor.fetchall()
     user_incomes = {}
     
-    import random
+    # Base income of 1-3 coins per prisoner, drawn in one call
+    base_incomes = random.choices((1, 2, 3), k=len(user_prisoners))
     
-    for row in user_prisoners:
-        owner_id = row[0]
-        prisoner_id = row[1]
-        prisoner_price = row[2]
-        
-        # Get upgrade multiplier for this prisoner
-        upgrade_info = get_prisoner_upgrade_info(prisoner_id)
-        income_multiplier = upgrade_info['multiplier']
-        
-        # Calculate base income (1-3 coins per prisoner)
-        base_income = random.randint(1, 3)
-        
+    for (owner_id, owners_owner_id, _, _, income_multiplier), base_income in zip(user_prisoners, base_incomes):
         # Apply upgrade multiplier
         enhanced_income = int(base_income * income_multiplier)
         
         # Add to owner's total income
         if owner_id not in user_incomes:
-            user_incomes[owner_id] = {'total_income': 0, 'prisoner_count': 0, 'generated_profit': 0}
+            user_incomes[owner_id] = {'total_income': 0, 'prisoner_count': 0, 'owner_id': owners_owner_id}
         
         user_incomes[owner_id]['total_income'] += enhanced_income
         user_incomes[owner_id]['prisoner_count'] += 1
-        user_incomes[owner_id]['generated_profit'] += enhanced_income
     
-    # Update balances and log income/profit
+    if not user_incomes:
+        return
+    
+    # Received income for each owner, generated profit for the owner's own owner
+    profit_entries = {}
     for user_id, income_data in user_incomes.items():
-        total_income = income_data['total_income']
-        prisoner_count = income_data['prisoner_count']
-        generated_profit = income_data['generated_profit']
-        
-        # Update user balance
-        cursor.execute('''
+        profit_entries.setdefault(user_id, [0, 0])[1] += income_data['total_income']
+        if income_data['owner_id']:
+            profit_entries.setdefault(income_data['owner_id'], [0, 0])[0] += income_data['total_income']
+    
+    try:
+        # Update balances and log income/profit in a single transaction
+        cursor.executemany('''
             UPDATE users SET balance = balance + ?, last_income = CURRENT_TIMESTAMP
             WHERE telegram_id = ?
-        ''', (total_income, user_id))
+        ''', [(data['total_income'], user_id) for user_id, data in user_incomes.items()])
         
-        # Log income
-        cursor.execute('''
+        cursor.executemany('''
             INSERT INTO income_log (user_id, amount, prisoner_count)
             VALUES (?, ?, ?)
-        ''', (user_id, total_income, prisoner_count))
+        ''', [(user_id, data['total_income'], data['prisoner_count']) for user_id, data in user_incomes.items()])
         
-        # Log profit data (user generated profit for their owner)
-        log_profit_data(user_id, 0, total_income)  # received income
-        
-        # Log that this user generated profit for their owner
-        user = get_user(user_id)
-        if user and user['owner_id']:
-            log_profit_data(user['owner_id'], generated_profit, 0)  # generated profit
-        
-        # Log transaction
-        cursor.execute('''
+        cursor.executemany('''
             INSERT INTO transactions (from_user_id, to_user_id, amount, transaction_type, description)
             VALUES (NULL, ?, ?, 'income', 'Почасовой доход с заключённых')
-        ''', (user_id, total_income))
+        ''', [(user_id, data['total_income']) for user_id, data in user_incomes.items()])
+        
+        log_profit_data(profit_entries, conn=conn)
+        
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error generating hourly income: {e}")
+        return
     
-    conn.commit()
+    invalidate_user_caches()
     logger.info(f"Generated hourly income for {len(user_incomes)} users")
 
 def get_user_by_referral_code(referral_code: str) -> Optional[Dict]:
-    """Get user by referral code"""
+    """Get user ID and names by referral code"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('SELECT * FROM users WHERE referral_code = ?', (referral_code,))
+    cursor.execute('SELECT telegram_id, username, first_name FROM users WHERE referral_code = ?', (referral_code,))
+    row = cursor.fetchone()
+    
+    if row:
+        return dict(row)
+    return None
+
+def apply_referral_capture(user_id: int, referrer_id: int, username: str = None, first_name: str = None,
+                           is_new_user: bool = False) -> bool:
+    """Register or refresh a user and hand them to their referrer in one transaction"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        if is_new_user:
+            if not create_user(user_id, username, first_name, referrer_id, conn=conn):
+                conn.rollback()
+                return False
+            
+            # Award 1 point for successful referral
+            cursor.execute('UPDATE users SET points = points + 1.0 WHERE telegram_id = ?', (referrer_id,))
+            captured = True
+        else:
+            cursor.execute('''
+                UPDATE users SET username = ?, first_name = ? WHERE telegram_id = ?
+            ''', (username, first_name, user_id))
+            
+            # Only free users can be captured
+            cursor.execute('''
+                UPDATE users SET owner_id = ? WHERE telegram_id = ? AND owner_id IS NULL
+            ''', (referrer_id, user_id))
+            captured = cursor.rowcount > 0
+        
+        conn.commit()
+        invalidate_user_caches(user_id, referrer_id)
+        return captured
+        
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error applying referral capture of {user_id} by {referrer_id}: {e}")
+        return False
+
+def get_user_by_username(username: str) -> Optional[Dict]:
+    """Get user ID and names by username (None if no user or several users carry it)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    user_id = resolve_username(cursor, username)
+    if user_id is None:
+        return None
+    
+    cursor.execute('SELECT telegram_id, username, first_name FROM users WHERE telegram_id = ?', (user_id,))
     row = cursor.fetchone()
     
     if row:
@@ -608,9 +1068,11 @@ def update_user_info(telegram_id: int, username: str = None, first_name: str = N
     ''', (username, first_name, telegram_id))
     
     conn.commit()
+    invalidate_user_caches(telegram_id)
 
-def send_prisoners_to_work(owner_id: int) -> Tuple[bool, str, int]:
-    """Send all prisoners of an owner to work for 1 hour"""
+@transactional
+def send_prisoners_to_work(owner_id: int) -> Tuple[bool, str, int, List[Dict]]:
+    """Send all prisoners of an owner to work for 1 hour, returns the prisoners for the keyboard"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -618,7 +1080,7 @@ def send_prisoners_to_work(owner_id: int) -> Tuple[bool, str, int]:
     prisoners = get_my_prisoners(owner_id)
     
     if not prisoners:
-        return False, "У тебя нет заключённых для отправки на работу! 🤷‍♂️", 0
+        return False, "У тебя нет заключённых для отправки на работу! 🤷‍♂️", 0, prisoners
     
     # Check if any prisoners are already working
     cursor.execute('''
@@ -628,31 +1090,26 @@ def send_prisoners_to_work(owner_id: int) -> Tuple[bool, str, int]:
     
     active_jobs = cursor.fetchone()[0]
     if active_jobs > 0:
-        return False, "Твои заключённые уже работают! Дождись завершения текущих заданий. ⏰", 0
-    
-    total_expected_reward = 0
-    
-    # Create work assignments for each prisoner
-    for prisoner in prisoners:
-        # Calculate expected reward based on prisoner's price (level)
-        base_reward = max(5, prisoner['price'] // 20)  # Minimum 5 coins, scales with price
-        import random
-        reward_multiplier = random.uniform(0.8, 1.2)  # Random factor
-        expected_reward = int(base_reward * reward_multiplier)
-        total_expected_reward += expected_reward
-        
-        # Insert work assignment
-        cursor.execute('''
-            INSERT INTO work_assignments (owner_id, prisoner_id, end_time, expected_reward)
-            VALUES (?, ?, datetime('now', '+1 hour'), ?)
-        ''', (owner_id, prisoner['telegram_id'], expected_reward))
+        return False, "Твои заключённые уже работают! Дождись завершения текущих заданий. ⏰", 0, prisoners
     
-    conn.commit()
+    # Expected reward scales with prisoner's price (level), minimum 5 coins, with a ±20% random factor
+    assignments = [
+        (owner_id, prisoner['telegram_id'], int(max(5, prisoner['price'] // 20) * random.uniform(0.8, 1.2)))
+        for prisoner in prisoners
+    ]
+    total_expected_reward = sum(assignment[2] for assignment in assignments)
+    
+    # Create work assignments for all prisoners at once
+    cursor.executemany('''
+        INSERT INTO work_assignments (owner_id, prisoner_id, end_time, expected_reward)
+        VALUES (?, ?, datetime('now', '+1 hour'), ?)
+    ''', assignments)
     
-    return True, f"🏭 Отправил {len(prisoners)} заключённых на работу!\nОжидаемая прибыль: {total_expected_reward} монет\nВремя завершения: через 1 час", len(prisoners)
+    return True, f"🏭 Отправил {len(prisoners)} заключённых на работу!\nОжидаемая прибыль: {total_expected_reward} монет\nВремя завершения: через 1 час", len(prisoners), prisoners
 
-def collect_work_rewards(owner_id: int) -> Tuple[bool, str, int]:
-    """Collect rewards from completed work assignments"""
+@transactional
+def collect_work_rewards(owner_id: int) -> Tuple[bool, str, int, List[Dict], Optional[int]]:
+    """Collect rewards from completed work assignments, returns the prisoners and the new balance"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -666,128 +1123,103 @@ def collect_work_rewards(owner_id: int) -> Tuple[bool, str, int]:
     ''', (owner_id,))
     
     completed_jobs = cursor.fetchall()
+    prisoners = get_my_prisoners(owner_id)
     
     if not completed_jobs:
-        return False, "Нет готовых заданий для сбора награды! 🕐", 0
+        return False, "Нет готовых заданий для сбора награды! 🕐", 0, prisoners, None
     
+    # Rows are only read here, so they are used as-is without dict copies
     total_reward = 0
     prisoner_names = []
     
     for job in completed_jobs:
-        job_dict = dict(job)
-        reward = job_dict['expected_reward']
-        total_reward += reward
+        total_reward += job['expected_reward']
         
-        prisoner_name = job_dict['username'] or job_dict['first_name'] or f"ID{job_dict['prisoner_id']}"
+        prisoner_name = display_name(job, job['prisoner_id'])
         prisoner_names.append(f"@{prisoner_name}")
-        
-        # Mark as completed
-        cursor.execute('''
-            UPDATE work_assignments SET completed = TRUE WHERE id = ?
-        ''', (job_dict['id'],))
+    
+    # Mark as completed
+    cursor.executemany('''
+        UPDATE work_assignments SET completed = TRUE WHERE id = ?
+    ''', [(job['id'],) for job in completed_jobs])
     
     # Add reward to owner's balance
     cursor.execute('''
-        UPDATE users SET balance = balance + ? WHERE telegram_id = ?
+        UPDATE users SET balance = balance + ? WHERE telegram_id = ? RETURNING balance
     ''', (total_reward, owner_id))
+    new_balance = cursor.fetchone()[0]
     
     # Log transaction
-    cursor.execute('''
-        INSERT INTO transactions (from_user_id, to_user_id, amount, transaction_type, description)
-        VALUES (NULL, ?, ?, 'work_reward', 'Награда за работу заключённых')
-    ''', (owner_id, total_reward))
-    
-    conn.commit()
+    log_transactions(cursor, [(None, owner_id, total_reward, 'work_reward', 'Награда за работу заключённых')])
+    after_commit(invalidate_user_caches, owner_id)
     
     workers_text = ", ".join(prisoner_names[:3])
     if len(prisoner_names) > 3:
         workers_text += f" и ещё {len(prisoner_names) - 3}"
     
-    return True, f"💰 Собрал награду за работу!\nРаботники: {workers_text}\nПолучено: {total_reward} монет", total_reward
+    return True, f"💰 Собрал награду за работу!\nРаботники: {workers_text}\nПолучено: {total_reward} монет", total_reward, prisoners, new_balance
 
 def get_work_status(owner_id: int) -> Dict:
     """Get current work status for owner's prisoners"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Get active work assignments
+    # Count active work assignments by readiness in one pass
     cursor.execute('''
-        SELECT wa.*, u.username, u.first_name 
+        SELECT COUNT(*),
+               COALESCE(SUM(wa.expected_reward), 0),
+               COALESCE(SUM(CASE WHEN datetime('now') >= wa.end_time THEN 1 ELSE 0 END), 0)
         FROM work_assignments wa
         JOIN users u ON wa.prisoner_id = u.telegram_id
         WHERE wa.owner_id = ? AND wa.completed = FALSE
     ''', (owner_id,))
     
-    active_jobs = cursor.fetchall()
-    
-    if not active_jobs:
-        return {
-            'has_active_jobs': False,
-            'workers_count': 0,
-            'total_expected': 0,
-            'ready_to_collect': 0,
-            'still_working': 0
-        }
-    
-    ready_count = 0
-    working_count = 0
-    total_expected = 0
-    
-    for job in active_jobs:
-        job_dict = dict(job)
-        total_expected += job_dict['expected_reward']
-        
-        # Check if job is completed
-        cursor.execute('''
-            SELECT datetime('now') >= ?
-        ''', (job_dict['end_time'],))
-        
-        is_ready = cursor.fetchone()[0]
-        
-        if is_ready:
-            ready_count += 1
-        else:
-            working_count += 1
+    workers_count, total_expected, ready_count = cursor.fetchone()
     
     return {
-        'has_active_jobs': True,
-        'workers_count': len(active_jobs),
+        'has_active_jobs': workers_count > 0,
+        'workers_count': workers_count,
         'total_expected': total_expected,
         'ready_to_collect': ready_count,
-        'still_working': working_count
+        'still_working': workers_count - ready_count
     }
 
+@transactional
 def buy_self_freedom(user_id: int) -> Tuple[bool, str]:
     """Allow prisoner to buy their own freedom"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    user = get_user(user_id)
-    if not user:
+    # Read the row inside the transaction; a cached copy may already be out of date
+    cursor.execute('''
+        SELECT owner_id, price, balance, shield_active, shield_until FROM users WHERE telegram_id = ?
+    ''', (user_id,))
+    row = cursor.fetchone()
+    if not row:
         return False, "Пользователь не найден!"
     
+    old_owner_id, freedom_price, balance, shield_active, shield_until = row
+    
     # Check if user is actually owned by someone
-    if not user['owner_id']:
+    if not old_owner_id:
         return False, "Ты уже свободен! 🆓"
     
     # Check if user has enough money to buy themselves
-    freedom_price = user['price']
-    if user['balance'] < freedom_price:
-        return False, f"Недостаточно монет для самовыкупа! Нужно {freedom_price}, а у тебя {user['balance']} монет. 💸"
+    if balance < freedom_price:
+        return False, f"Недостаточно монет для самовыкупа! Нужно {freedom_price}, а у тебя {balance} монет. 💸"
     
     # Check if shield is active
-    if user.get('shield_active') and user.get('shield_until'):
-        cursor.execute('SELECT datetime("now") < ?', (user['shield_until'],))
-        shield_active = cursor.fetchone()[0]
-        if shield_active:
+    if shield_active and shield_until:
+        if shield_hours_left(shield_until) is not None:
             return False, "На тебе стоит защитный щит! Самовыкуп невозможен до его истечения. 🛡️"
     
-    old_owner_id = user['owner_id']
-    
-    # Remove ownership and deduct money
+    # Remove ownership and deduct money, only from the state checked above
     cursor.execute('''
-        UPDATE users SET owner_id = NULL, balance = balance - ? WHERE telegram_id = ?
-    ''', (freedom_price, user_id))
+        UPDATE users SET owner_id = NULL, balance = balance - ?
+        WHERE telegram_id = ? AND owner_id IS ? AND balance >= ?
+    ''', (freedom_price, user_id, old_owner_id, freedom_price))
+    if cursor.rowcount != 1:
+        return False, "Владелец или баланс изменились, попробуй ещё раз! 🔄"
     
     # Add ownership history
     cursor.execute('''
@@ -796,39 +1228,44 @@ def buy_self_freedom(user_id: int) -> Tuple[bool, str]:
     ''', (user_id, old_owner_id, freedom_price))
     
     # Log transaction
-    cursor.execute('''
-        INSERT INTO transactions (from_user_id, to_user_id, amount, transaction_type, description)
-        VALUES (?, NULL, ?, 'self_buyout', 'Самовыкуп из тюрьмы')
-    ''', (user_id, freedom_price))
-    
-    conn.commit()
+    log_transactions(cursor, [(user_id, None, freedom_price, 'self_buyout', 'Самовыкуп из тюрьмы')])
+    after_commit(invalidate_user_caches, user_id, old_owner_id)
     
     return True, f"🆓 Поздравляю! Ты выкупил свою свободу за {freedom_price} монет!\nТеперь ты свободен и никому не принадлежишь!"
 
+@transactional
 def activate_shield(owner_id: int, prisoner_id: int) -> Tuple[bool, str]:
     """Activate protection shield for a prisoner"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
+    # Ownership, shield state, price and the owner's balance in one read
+    cursor.execute('''
+        SELECT p.owner_id, p.price, p.shield_active, p.shield_until,
+               p.username, p.first_name, o.balance
+        FROM users p
+        JOIN users o ON o.telegram_id = ?
+        WHERE p.telegram_id = ?
+    ''', (owner_id, prisoner_id))
+    row = cursor.fetchone()
+    
     # Check if owner actually owns this prisoner
-    prisoner = get_user(prisoner_id)
-    if not prisoner or prisoner['owner_id'] != owner_id:
+    if not row or row[0] != owner_id:
         return False, "Этот заключённый тебе не принадлежит! 🚫"
     
+    _, price, shield_active, shield_until, _, _, balance = row
+    
     # Check if shield is already active
-    if prisoner.get('shield_active') and prisoner.get('shield_until'):
-        cursor.execute('SELECT datetime("now") < ?', (prisoner['shield_until'],))
-        shield_active = cursor.fetchone()[0]
-        if shield_active:
+    if shield_active and shield_until:
+        if shield_hours_left(shield_until) is not None:
             return False, "На этом заключённом уже стоит активный щит! 🛡️"
     
     # Calculate shield cost (35% of prisoner's price)
-    shield_cost = int(prisoner['price'] * 0.35)
+    shield_cost = int(price * 0.35)
     
     # Check owner's balance
-    owner = get_user(owner_id)
-    if owner['balance'] < shield_cost:
-        return False, f"Недостаточно монет для активации щита! Нужно {shield_cost}, а у тебя {owner['balance']} монет. 💸"
+    if balance < shield_cost:
+        return False, f"Недостаточно монет для активации щита! Нужно {shield_cost}, а у тебя {balance} монет. 💸"
     
     # Activate shield for 24 hours
     cursor.execute('''
@@ -836,6 +1273,8 @@ def activate_shield(owner_id: int, prisoner_id: int) -> Tuple[bool, str]:
         SET shield_active = TRUE, shield_until = datetime('now', '+24 hours')
         WHERE telegram_id = ?
     ''', (prisoner_id,))
+    if active_shield_ids is not None:
+        after_commit(active_shield_ids.add, prisoner_id)
     
     # Deduct cost from owner
     cursor.execute('''
@@ -843,19 +1282,19 @@ def activate_shield(owner_id: int, prisoner_id: int) -> Tuple[bool, str]:
     ''', (shield_cost, owner_id))
     
     # Log transaction
-    cursor.execute('''
-        INSERT INTO transactions (from_user_id, to_user_id, amount, transaction_type, description)
-        VALUES (?, ?, ?, 'shield_activation', 'Активация защитного щита')
-    ''', (owner_id, prisoner_id, shield_cost))
-    
-    conn.commit()
+    log_transactions(cursor, [(owner_id, prisoner_id, shield_cost, 'shield_activation', 'Активация защитного щита')])
+    after_commit(invalidate_user_caches, owner_id, prisoner_id)
     
-    prisoner_name = prisoner['username'] or prisoner['first_name'] or f"ID{prisoner_id}"
+    prisoner_name = display_name(row, prisoner_id)
     
     return True, f"🛡️ Защитный щит активирован!\nЗаключённый: @{prisoner_name}\nСтоимость: {shield_cost} монет\nДействует: 24 часа"
 
-def get_prisoner_upgrade_info(prisoner_id: int) -> Dict:
+def get_prisoner_upgrade_info(prisoner_id: int) -> UpgradeInfo:
     """Get upgrade information for a prisoner"""
+    cached = upgrade_info_cache.get(prisoner_id)
+    if cached is not None:
+        return cached
+    
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -866,114 +1305,111 @@ def get_prisoner_upgrade_info(prisoner_id: int) -> Dict:
     ''', (prisoner_id,))
     
     result = cursor.fetchone()
-    if result:
-        return {
-            'level': result[0],
-            'multiplier': result[1],
-            'next_cost': result[2],
-            'total_invested': result[3]
-        }
-    else:
-        # Create initial upgrade record
-        cursor.execute('''
-            INSERT INTO prisoner_upgrades (prisoner_id, upgrade_level, income_multiplier, upgrade_cost)
-            VALUES (?, 1, 1.0, 100)
-        ''', (prisoner_id,))
-        conn.commit()
-        return {
-            'level': 1,
-            'multiplier': 1.0,
-            'next_cost': 100,
-            'total_invested': 0
-        }
+    # Not upgraded yet; the record is created by the first upgrade
+    upgrade_info = UpgradeInfo(*result) if result else DEFAULT_UPGRADE_INFO
+    
+    upgrade_info_cache.set(prisoner_id, upgrade_info)
+    return upgrade_info
 
+@transactional
 def upgrade_prisoner(owner_id: int, prisoner_id: int) -> Tuple[bool, str]:
     """Upgrade a prisoner to increase their income generation"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
+    # Ownership, owner's balance and current upgrade state in one read
+    cursor.execute('''
+        SELECT p.owner_id, o.balance, pu.id IS NOT NULL,
+               COALESCE(pu.upgrade_level, 1), COALESCE(CAST(ROUND(pu.income_multiplier * 100) AS INTEGER), 100),
+               COALESCE(pu.upgrade_cost, 100), COALESCE(pu.total_invested, 0)
+        FROM users p
+        JOIN users o ON o.telegram_id = ?
+        LEFT JOIN prisoner_upgrades pu ON pu.id = (
+            SELECT id FROM prisoner_upgrades WHERE prisoner_id = p.telegram_id ORDER BY id LIMIT 1
+        )
+        WHERE p.telegram_id = ?
+    ''', (owner_id, prisoner_id))
+    row = cursor.fetchone()
+    
     # Check if owner actually owns this prisoner
-    prisoner = get_user(prisoner_id)
-    if not prisoner or prisoner['owner_id'] != owner_id:
+    if not row or row[0] != owner_id:
         return False, "Ты не владеешь этим заключённым!"
     
-    # Get current upgrade info
-    upgrade_info = get_prisoner_upgrade_info(prisoner_id)
-    upgrade_cost = upgrade_info['next_cost']
+    _, balance, has_upgrade_record, level, multiplier_x100, upgrade_cost, total_invested = row
     
     # Check owner's balance
-    owner = get_user(owner_id)
-    if owner['balance'] < upgrade_cost:
+    if balance < upgrade_cost:
         return False, f"Недостаточно монет! Нужно {upgrade_cost} монет для улучшения."
     
-    # Calculate new stats
-    new_level = upgrade_info['level'] + 1
-    new_multiplier = round(upgrade_info['multiplier'] * 1.2, 2)  # 20% increase per level
-    new_upgrade_cost = int(upgrade_cost * 1.5)  # Cost increases by 50% each level
-    new_total_invested = upgrade_info['total_invested'] + upgrade_cost
+    # Calculate new stats in integers; the multiplier is kept in hundredths (100 = ×1.0)
+    new_level = level + 1
+    new_multiplier_x100 = (multiplier_x100 * 12 + 5) // 10  # 20% increase per level, rounded half up
+    new_multiplier = new_multiplier_x100 / 100
+    new_upgrade_cost = upgrade_cost * 3 // 2  # Cost increases by 50% each level
+    new_total_invested = total_invested + upgrade_cost
     
     # Update owner's balance
     cursor.execute('''
         UPDATE users SET balance = balance - ? WHERE telegram_id = ?
     ''', (upgrade_cost, owner_id))
     
-    # Update upgrade info
-    cursor.execute('''
-        UPDATE prisoner_upgrades 
-        SET upgrade_level = ?, income_multiplier = ?, upgrade_cost = ?, 
-            total_invested = ?, last_upgraded = CURRENT_TIMESTAMP
-        WHERE prisoner_id = ?
-    ''', (new_level, new_multiplier, new_upgrade_cost, new_total_invested, prisoner_id))
+    # Update upgrade info, creating the record on the first upgrade
+    if has_upgrade_record:
+        cursor.execute('''
+            UPDATE prisoner_upgrades 
+            SET upgrade_level = ?, income_multiplier = ?, upgrade_cost = ?, 
+                total_invested = ?, last_upgraded = CURRENT_TIMESTAMP
+            WHERE prisoner_id = ?
+        ''', (new_level, new_multiplier, new_upgrade_cost, new_total_invested, prisoner_id))
+    else:
+        cursor.execute('''
+            INSERT INTO prisoner_upgrades (prisoner_id, upgrade_level, income_multiplier, upgrade_cost, total_invested)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (prisoner_id, new_level, new_multiplier, new_upgrade_cost, new_total_invested))
     
     # Update prisoner's price based on investment
-    price_increase = int(upgrade_cost * 0.8)  # 80% of upgrade cost added to price
+    price_increase = upgrade_cost * 4 // 5  # 80% of upgrade cost added to price
     cursor.execute('''
         UPDATE users SET price = price + ? WHERE telegram_id = ?
     ''', (price_increase, prisoner_id))
     
     # Log transaction
-    cursor.execute('''
-        INSERT INTO transactions (from_user_id, to_user_id, amount, transaction_type, description)
-        VALUES (?, ?, ?, 'upgrade', 'Улучшение заключённого')
-    ''', (owner_id, prisoner_id, upgrade_cost))
-    
-    conn.commit()
+    log_transactions(cursor, [(owner_id, prisoner_id, upgrade_cost, 'upgrade', 'Улучшение заключённого')])
+    after_commit(invalidate_user_caches, owner_id, prisoner_id)
+    after_commit(upgrade_info_cache.pop, prisoner_id)
     
     return True, f"✅ Заключённый улучшен до уровня {new_level}! Множитель дохода: ×{new_multiplier}"
 
-def log_profit_data(user_id: int, profit_generated: int, profit_received: int):
-    """Log profit data for pricing calculations"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def log_profit_data(entries: Dict[int, Tuple[int, int]], conn: sqlite3.Connection = None):
+    """Log (generated, received) profit for many users, adding to today's record where one exists"""
+    if not entries:
+        return
     
-    # Check if there's a record for today
-    cursor.execute('''
-        SELECT id, profit_generated, profit_received 
-        FROM profit_log 
-        WHERE user_id = ? AND DATE(period_end) = DATE('now')
-    ''', (user_id,))
-    
-    result = cursor.fetchone()
-    if result:
-        # Update existing record
-        new_generated = result[1] + profit_generated
-        new_received = result[2] + profit_received
-        cursor.execute('''
-            UPDATE profit_log 
-            SET profit_generated = ?, profit_received = ?, period_end = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (new_generated, new_received, result[0]))
-    else:
-        # Create new record
-        cursor.execute('''
-            INSERT INTO profit_log (user_id, profit_generated, profit_received, period_start)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (user_id, profit_generated, profit_received))
+    owns_transaction = conn is None
+    conn = conn or get_db_connection()
+    cursor = conn.cursor()
     
-    conn.commit()
+    # Add to today's record, or start it
+    cursor.executemany('''
+        INSERT INTO profit_log (user_id, profit_generated, profit_received, period_start)
+        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id, DATE(period_end)) DO UPDATE SET
+            profit_generated = profit_generated + excluded.profit_generated,
+            profit_received = profit_received + excluded.profit_received,
+            period_end = CURRENT_TIMESTAMP
+    ''', [(user_id, generated, received) for user_id, (generated, received) in entries.items()])
+    
+    if owns_transaction:
+        conn.commit()
+    for user_id in entries:
+        profit_stats_cache.pop(user_id)
 
 def get_profit_statistics(user_id: int) -> Dict:
     """Get profit statistics for a user"""
+    cached = profit_stats_cache.get(user_id)
+    if cached is not None:
+        return dict(cached)
+    
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -986,12 +1422,12 @@ def get_profit_statistics(user_id: int) -> Dict:
             COALESCE(AVG(profit_received), 0) as avg_received,
             COUNT(*) as days_active
         FROM profit_log 
-        WHERE user_id = ? AND period_end > datetime('now', '-7 days')
-    ''', (user_id,))
+        WHERE user_id = ? AND period_end > ?
+    ''', (user_id, timestamp_cutoff(7)))
     
     result = cursor.fetchone()
     if result:
-        return {
+        profit_stats = {
             'total_generated': int(result[0]),
             'total_received': int(result[1]),
             'avg_generated': int(result[2]),
@@ -1000,7 +1436,7 @@ def get_profit_statistics(user_id: int) -> Dict:
             'net_profit': int(result[1] - result[0])  # received - generated
         }
     else:
-        return {
+        profit_stats = {
             'total_generated': 0,
             'total_received': 0,
             'avg_generated': 0,
@@ -1008,47 +1444,223 @@ def get_profit_statistics(user_id: int) -> Dict:
             'days_active': 0,
             'net_profit': 0
         }
+    
+    profit_stats_cache.set(user_id, profit_stats)
+    return dict(profit_stats)
+
+def get_price_analysis_bundle(user_id: int) -> Optional[Dict]:
+    """Get every aggregate the price multipliers need in a single query"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        WITH trades AS (
+            SELECT COUNT(*) as trade_count,
+                   AVG(price) as avg_trade_price,
+                   MAX(price) as max_trade_price
+            FROM ownership_history
+            WHERE prisoner_id = :user_id AND timestamp > :month_ago
+        ),
+        income AS (
+            SELECT COUNT(*) as income_count,
+                   AVG(amount) as avg_income,
+                   AVG(amount * amount) - AVG(amount) * AVG(amount) as income_variance,
+                   COUNT(DISTINCT substr(timestamp, 1, 10)) as income_days
+            FROM income_log
+            WHERE user_id = :user_id AND timestamp > :week_ago
+        ),
+        owned AS (
+            SELECT COUNT(*) as prisoner_count,
+                   COALESCE(SUM(u.price), 0) as prisoners_value,
+                   COALESCE(SUM((SELECT pu.total_invested FROM prisoner_upgrades pu
+                                 WHERE pu.prisoner_id = u.telegram_id ORDER BY pu.id LIMIT 1)), 0) as upgrades_invested
+            FROM users u WHERE u.owner_id = :user_id
+        ),
+        purchases AS (
+            SELECT MIN(COUNT(*), 10) as purchase_count,
+                   AVG(CASE WHEN rn <= 3 THEN price END) as recent_purchase_avg,
+                   AVG(CASE WHEN rn BETWEEN 4 AND 6 THEN price END) as older_purchase_avg
+            FROM (
+                SELECT price, ROW_NUMBER() OVER (ORDER BY timestamp DESC, id DESC) as rn
+                FROM ownership_history WHERE new_owner_id = :user_id
+            )
+        ),
+        profit AS (
+            SELECT COALESCE(SUM(profit_generated), 0) as total_generated,
+                   COALESCE(SUM(profit_received), 0) as total_received,
+                   COALESCE(AVG(profit_generated), 0) as avg_generated,
+                   COALESCE(AVG(profit_received), 0) as avg_received,
+                   COUNT(*) as days_active
+            FROM profit_log WHERE user_id = :user_id AND period_end > :week_ago
+        )
+        SELECT u.price, trades.*, income.*, owned.*, purchases.*, profit.*
+        FROM users u, trades, income, owned, purchases, profit
+        WHERE u.telegram_id = :user_id
+    ''', {'user_id': user_id, 'month_ago': timestamp_cutoff(30), 'week_ago': timestamp_cutoff(7)})
+    
+    row = cursor.fetchone()
+    if not row:
+        return None
+    
+    return _price_stats_from_row(row)
+
+def get_all_price_analysis_bundles() -> Dict[int, Dict]:
+    """Get get_price_analysis_bundle() for every user in one grouped query, keyed by telegram ID"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        WITH trades AS (
+            SELECT prisoner_id as user_id,
+                   COUNT(*) as trade_count,
+                   AVG(price) as avg_trade_price,
+                   MAX(price) as max_trade_price
+            FROM ownership_history
+            WHERE timestamp > :month_ago
+            GROUP BY prisoner_id
+        ),
+        income AS (
+            SELECT user_id,
+                   COUNT(*) as income_count,
+                   AVG(amount) as avg_income,
+                   AVG(amount * amount) - AVG(amount) * AVG(amount) as income_variance,
+                   COUNT(DISTINCT substr(timestamp, 1, 10)) as income_days
+            FROM income_log
+            WHERE timestamp > :week_ago
+            GROUP BY user_id
+        ),
+        owned AS (
+            SELECT u.owner_id as user_id,
+                   COUNT(*) as prisoner_count,
+                   COALESCE(SUM(u.price), 0) as prisoners_value,
+                   COALESCE(SUM((SELECT pu.total_invested FROM prisoner_upgrades pu
+                                 WHERE pu.prisoner_id = u.telegram_id ORDER BY pu.id LIMIT 1)), 0) as upgrades_invested
+            FROM users u WHERE u.owner_id IS NOT NULL
+            GROUP BY u.owner_id
+        ),
+        purchases AS (
+            SELECT new_owner_id as user_id,
+                   MIN(COUNT(*), 10) as purchase_count,
+                   AVG(CASE WHEN rn <= 3 THEN price END) as recent_purchase_avg,
+                   AVG(CASE WHEN rn BETWEEN 4 AND 6 THEN price END) as older_purchase_avg
+            FROM (
+                SELECT new_owner_id, price,
+                       ROW_NUMBER() OVER (PARTITION BY new_owner_id ORDER BY timestamp DESC, id DESC) as rn
+                FROM ownership_history WHERE new_owner_id IS NOT NULL
+            )
+            GROUP BY new_owner_id
+        ),
+        profit AS (
+            SELECT user_id,
+                   SUM(profit_generated) as total_generated,
+                   SUM(profit_received) as total_received,
+                   AVG(profit_generated) as avg_generated,
+                   AVG(profit_received) as avg_received,
+                   COUNT(*) as days_active
+            FROM profit_log WHERE period_end > :week_ago
+            GROUP BY user_id
+        )
+        SELECT u.telegram_id, u.price,
+               COALESCE(t.trade_count, 0) as trade_count, t.avg_trade_price, t.max_trade_price,
+               COALESCE(i.income_count, 0) as income_count, i.avg_income, i.income_variance,
+               COALESCE(i.income_days, 0) as income_days,
+               COALESCE(o.prisoner_count, 0) as prisoner_count,
+               COALESCE(o.prisoners_value, 0) as prisoners_value,
+               COALESCE(o.upgrades_invested, 0) as upgrades_invested,
+               COALESCE(pc.purchase_count, 0) as purchase_count,
+               pc.recent_purchase_avg, pc.older_purchase_avg,
+               COALESCE(pr.total_generated, 0) as total_generated,
+               COALESCE(pr.total_received, 0) as total_received,
+               COALESCE(pr.avg_generated, 0) as avg_generated,
+               COALESCE(pr.avg_received, 0) as avg_received,
+               COALESCE(pr.days_active, 0) as days_active
+        FROM users u
+        LEFT JOIN trades t ON t.user_id = u.telegram_id
+        LEFT JOIN income i ON i.user_id = u.telegram_id
+        LEFT JOIN owned o ON o.user_id = u.telegram_id
+        LEFT JOIN purchases pc ON pc.user_id = u.telegram_id
+        LEFT JOIN profit pr ON pr.user_id = u.telegram_id
+    ''', {'month_ago': timestamp_cutoff(30), 'week_ago': timestamp_cutoff(7)})
+    
+    return {row['telegram_id']: _price_stats_from_row(row) for row in cursor.fetchall()}
+
+def _price_stats_from_row(row) -> Dict:
+    """Turn a price-analysis row into the stats dict, with profit figures grouped under 'profit'"""
+    stats = dict(row)
+    stats['profit'] = {
+        'total_generated': int(stats['total_generated']),
+        'total_received': int(stats['total_received']),
+        'avg_generated': int(stats['avg_generated']),
+        'avg_received': int(stats['avg_received']),
+        'days_active': stats['days_active'],
+        'net_profit': int(stats['total_received'] - stats['total_generated'])
+    }
+    return stats
+
+def get_shield_row(user_id: int) -> Optional[Tuple]:
+    """(shield_active, shield_until) for a user, without copying the whole users row"""
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached['shield_active'], cached['shield_until']
+    
+    cursor = get_db_connection().cursor()
+    cursor.execute('SELECT shield_active, shield_until FROM users WHERE telegram_id = ?', (user_id,))
+    return cursor.fetchone()
 
 def check_shield_status(user_id: int) -> Dict:
     """Check shield status for a user"""
-    user = get_user(user_id)
-    if not user:
+    if active_shield_ids is not None and user_id not in active_shield_ids:
         return {'has_shield': False, 'time_left': 0}
     
-    if not user.get('shield_active') or not user.get('shield_until'):
+    row = get_shield_row(user_id)
+    if not row:
         return {'has_shield': False, 'time_left': 0}
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    shield_active, shield_until = row
+    if not shield_active or not shield_until:
+        return {'has_shield': False, 'time_left': 0}
     
     # Check if shield is still active
-    cursor.execute('''
-        SELECT 
-            datetime("now") < ?,
-            CAST((julianday(?) - julianday("now")) * 24 AS INTEGER) as hours_left
-    ''', (user['shield_until'], user['shield_until']))
-    
-    result = cursor.fetchone()
-    is_active = result[0]
-    hours_left = max(0, result[1]) if result[1] else 0
+    hours_left = shield_hours_left(shield_until)
     
     # If shield expired, deactivate it
-    if not is_active:
+    if hours_left is None:
+        conn = get_db_connection()
+        cursor = conn.cursor()
         cursor.execute('''
             UPDATE users SET shield_active = FALSE, shield_until = NULL WHERE telegram_id = ?
         ''', (user_id,))
         conn.commit()
+        invalidate_user_caches(user_id)
+        if active_shield_ids is not None:
+            active_shield_ids.discard(user_id)
         return {'has_shield': False, 'time_left': 0}
     
     return {'has_shield': True, 'time_left': hours_left}
 
-def admin_add_coins(user_id: int, amount: int) -> bool:
-    """Admin function to add coins to a user"""
-    conn = get_db_connection()
+def resolve_username(cursor: sqlite3.Cursor, username: str) -> Optional[int]:
+    """telegram_id of the one user with this username (case-insensitive); None if none or several match"""
+    cursor.execute('SELECT telegram_id FROM users WHERE username = ? COLLATE NOCASE LIMIT 2', (username,))
+    rows = cursor.fetchall()
+    if len(rows) > 1:
+        logger.warning(f"Username @{username} matches several users, refusing to pick one")
+        return None
+    return rows[0][0] if rows else None
+
+def admin_add_coins(user_id: int, amount: int, conn: sqlite3.Connection = None) -> Optional[int]:
+    """Admin function to add coins to a user, returns the new balance (None if user not found or on error)"""
+    owns_transaction = conn is None
+    conn = conn or get_db_connection()
     cursor = conn.cursor()
     
     try:
-        cursor.execute('UPDATE users SET balance = balance + ? WHERE telegram_id = ?', (amount, user_id))
+        cursor.execute(
+            'UPDATE users SET balance = balance + ? WHERE telegram_id = ? RETURNING balance', (amount, user_id)
+        )
+        row = cursor.fetchone()
+        
+        if not row:
+            return None
         
         # Log admin transaction
         cursor.execute('''
@@ -1056,11 +1668,142 @@ def admin_add_coins(user_id: int, amount: int) -> bool:
             VALUES (?, ?, 'admin_add', 'Админ начислил монеты')
         ''', (user_id, amount))
         
-        conn.commit()
-        return True
+        if owns_transaction:
+            conn.commit()
+        invalidate_user_caches(user_id)
+        return row[0]
     except Exception as e:
+        if not owns_transaction:
+            raise
+        conn.rollback()
         logger.error(f"Error adding coins to user {user_id}: {e}")
-        return False
+        return None
+
+def admin_add_coins_by_username(username: str, amount: int, conn: sqlite3.Connection = None) -> Optional[Dict]:
+    """Admin function to add coins by username, returning the updated user in one round-trip"""
+    owns_transaction = conn is None
+    conn = conn or get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        target_id = resolve_username(cursor, username)
+        if target_id is None:
+            return None
+        
+        cursor.execute('''
+            UPDATE users SET balance = balance + ? WHERE telegram_id = ?
+            RETURNING telegram_id, username, balance
+        ''', (amount, target_id))
+        row = cursor.fetchone()
+
+        # Log admin transaction
+        cursor.execute('''
+            INSERT INTO transactions (to_user_id, amount, transaction_type, description)
+            VALUES (?, ?, 'admin_add', 'Админ начислил монеты')
+        ''', (row['telegram_id'], amount))
+
+        if owns_transaction:
+            conn.commit()
+        invalidate_user_caches(target_id)
+        return dict(row)
+    except Exception as e:
+        if not owns_transaction:
+            raise
+        conn.rollback()
+        logger.error(f"Error adding coins to @{username}: {e}")
+        return None
+
+def admin_set_coins_by_username(username: str, amount: int) -> Optional[Dict]:
+    """Admin function to set coins by username, returning the updated user in one round-trip"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        target_id = resolve_username(cursor, username)
+        if target_id is None:
+            return None
+        
+        cursor.execute('''
+            UPDATE users SET balance = ? WHERE telegram_id = ?
+            RETURNING telegram_id, username, balance
+        ''', (amount, target_id))
+        row = cursor.fetchone()
+        
+        # Log admin transaction
+        cursor.execute('''
+            INSERT INTO transactions (to_user_id, amount, transaction_type, description)
+            VALUES (?, ?, 'admin_set', 'Админ установил баланс')
+        ''', (row['telegram_id'], amount))
+        
+        conn.commit()
+        invalidate_user_caches(row['telegram_id'])
+        return dict(row)
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error setting coins for @{username}: {e}")
+        return None
+
+def admin_set_points_by_username(username: str, amount: float) -> Optional[Dict]:
+    """Admin function to set points by username, returning the updated user in one round-trip"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        target_id = resolve_username(cursor, username)
+        if target_id is None:
+            return None
+        
+        cursor.execute('''
+            UPDATE users SET points = ? WHERE telegram_id = ?
+            RETURNING telegram_id, username, points
+        ''', (amount, target_id))
+        row = cursor.fetchone()
+        
+        conn.commit()
+        invalidate_user_caches(row['telegram_id'])
+        return dict(row)
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error setting points for @{username}: {e}")
+        return None
+
+def admin_add_coins_bulk(credits: List[Tuple[str, int]], chunk_size: int = 1000,
+                         conn: sqlite3.Connection = None) -> int:
+    """Admin function to add coins to many users by username, returns number of credited users"""
+    owns_transaction = conn is None
+    conn = conn or get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        # Resolve every name to exactly one user first; unknown and ambiguous names are skipped
+        resolved = [(amount, resolve_username(cursor, username)) for username, amount in credits]
+        resolved = [(amount, telegram_id) for amount, telegram_id in resolved if telegram_id is not None]
+        skipped = len(credits) - len(resolved)
+        if skipped:
+            logger.warning(f"Skipped {skipped} of {len(credits)} credits with unknown or ambiguous usernames")
+
+        for start in range(0, len(resolved), chunk_size):
+            chunk = resolved[start:start + chunk_size]
+
+            cursor.executemany('UPDATE users SET balance = balance + ? WHERE telegram_id = ?', chunk)
+
+            # Log admin transactions
+            cursor.executemany('''
+                INSERT INTO transactions (to_user_id, amount, transaction_type, description)
+                VALUES (?, ?, 'admin_add', 'Админ начислил монеты')
+            ''', [(telegram_id, amount) for amount, telegram_id in chunk])
+
+        if owns_transaction:
+            conn.commit()
+        if resolved:
+            invalidate_user_caches(*{telegram_id for _, telegram_id in resolved})
+        return len(resolved)
+    except Exception as e:
+        if not owns_transaction:
+            raise
+        conn.rollback()
+        logger.error(f"Error adding coins in bulk: {e}")
+        return 0
 
 def admin_set_coins(user_id: int, amount: int) -> bool:
     """Admin function to set user's coins to specific amount"""
@@ -1077,6 +1820,7 @@ def admin_set_coins(user_id: int, amount: int) -> bool:
         ''', (user_id, amount))
         
         conn.commit()
+        invalidate_user_caches(user_id)
         return True
     except Exception as e:
         logger.error(f"Error setting coins for user {user_id}: {e}")
@@ -1090,6 +1834,7 @@ def admin_set_points(user_id: int, amount: float) -> bool:
     try:
         cursor.execute('UPDATE users SET points = ? WHERE telegram_id = ?', (amount, user_id))
         conn.commit()
+        invalidate_user_caches(user_id)
         return True
     except Exception as e:
         logger.error(f"Error setting points for user {user_id}: {e}")
@@ -1111,22 +1856,57 @@ def admin_get_all_users() -> List[Dict]:
             u.owner_id,
             u.created_at,
             owner.username as owner_username,
-            COUNT(prisoners.telegram_id) as prisoner_count
+            u.owned_count as prisoner_count
         FROM users u
         LEFT JOIN users owner ON u.owner_id = owner.telegram_id
-        LEFT JOIN users prisoners ON prisoners.owner_id = u.telegram_id
-        GROUP BY u.telegram_id
         ORDER BY u.balance DESC
     ''')
     
     rows = cursor.fetchall()
     return [dict(row) for row in rows]
 
-def admin_get_user_by_username(username: str) -> Optional[Dict]:
-    """Admin function to get user by username"""
+def admin_get_users_page(limit: int = 20, offset: int = 0) -> List[Dict]:
+    """Admin function to get one page of users ordered by balance"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        SELECT 
+            u.telegram_id,
+            u.username,
+            u.first_name,
+            u.balance,
+            u.points,
+            u.price,
+            u.owner_id,
+            u.created_at,
+            owner.username as owner_username,
+            u.owned_count as prisoner_count
+        FROM users u
+        LEFT JOIN users owner ON u.owner_id = owner.telegram_id
+        ORDER BY u.balance DESC
+        LIMIT ? OFFSET ?
+    ''', (limit, offset))
+    
+    return [dict(row) for row in cursor.fetchall()]
+
+def admin_count_users() -> int:
+    """Admin function to count all users"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
+    cursor.execute('SELECT COUNT(*) FROM users')
+    return cursor.fetchone()[0]
+
+def admin_get_user_by_username(username: str, conn: sqlite3.Connection = None) -> Optional[Dict]:
+    """Admin function to get user by username (None if no user or several users carry it)"""
+    conn = conn or get_db_connection()
+    cursor = conn.cursor()
+    
+    user_id = resolve_username(cursor, username)
+    if user_id is None:
+        return None
+    
     cursor.execute('''
         SELECT 
             u.telegram_id,
@@ -1138,13 +1918,11 @@ def admin_get_user_by_username(username: str) -> Optional[Dict]:
             u.owner_id,
             u.created_at,
             owner.username as owner_username,
-            COUNT(prisoners.telegram_id) as prisoner_count
+            u.owned_count as prisoner_count
         FROM users u
         LEFT JOIN users owner ON u.owner_id = owner.telegram_id
-        LEFT JOIN users prisoners ON prisoners.owner_id = u.telegram_id
-        WHERE u.username = ?
-        GROUP BY u.telegram_id
-    ''', (username,))
+        WHERE u.telegram_id = ?
+    ''', (user_id,))
     
     row = cursor.fetchone()
     return dict(row) if row else None
@@ -9,7 +9,8 @@ from typing import Dict, List, Tuple, Optional, Any
 from datetime import datetime, timedelta
 from database import (
     get_user, update_user_balance, get_my_prisoners, 
-    get_db_connection, get_random_prisoners
+    get_db_connection, get_random_prisoners, get_price_analysis_bundle,
+    timestamp_cutoff, day_start_timestamp
 )
 
 logger = logging.getLogger(__name__)
@@ -31,13 +32,9 @@ class GameLogic:
         if prisoner_count == 0:
             return 0
         
-        total_income = 0
-        for _ in range(prisoner_count):
-            # Each prisoner generates 1-3 coins per hour
-            income = random.randint(GameLogic.MIN_HOURLY_INCOME, GameLogic.MAX_HOURLY_INCOME)
-            total_income += income
-            
-        return total_income
+        # Each prisoner generates 1-3 coins per hour, all drawn in one call
+        incomes = range(GameLogic.MIN_HOURLY_INCOME, GameLogic.MAX_HOURLY_INCOME + 1)
+        return sum(random.choices(incomes, k=prisoner_count))
     
     @staticmethod
     def calculate_new_price(current_price: int) -> int:
@@ -47,29 +44,21 @@ class GameLogic:
     @staticmethod
     def calculate_dynamic_price(user_id: int) -> int:
         """Calculate dynamic price based on trading history, income stability, and prisoner parameters"""
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        user = get_user(user_id)
-        if not user:
+        stats = get_price_analysis_bundle(user_id)
+        if not stats:
             return GameLogic.STARTING_PRICE
         
-        base_price = user['price']
-        
-        # Factor 1: Trading History (Liquidity)
-        liquidity_multiplier = GameLogic._calculate_liquidity_multiplier(user_id, cursor)
-        
-        # Factor 2: Income Stability
-        stability_multiplier = GameLogic._calculate_income_stability_multiplier(user_id, cursor)
-        
-        # Factor 3: Prisoner Empire Parameters
-        empire_multiplier = GameLogic._calculate_empire_multiplier(user_id, cursor)
-        
-        # Factor 4: Profit Performance
-        profit_multiplier = GameLogic._calculate_profit_multiplier(user_id, cursor)
+        return GameLogic.calculate_price_from_stats(stats)
+    
+    @staticmethod
+    def calculate_price_from_stats(stats: Dict) -> int:
+        """Calculate dynamic price from get_price_analysis_bundle() output"""
+        base_price = stats['price']
+        multipliers = GameLogic.calculate_price_multipliers(stats)
         
         # Combine all multipliers (cap at reasonable limits)
-        total_multiplier = min(4.0, max(0.5, liquidity_multiplier * stability_multiplier * empire_multiplier * profit_multiplier))
+        total_multiplier = min(4.0, max(0.5, multipliers['liquidity'] * multipliers['stability'] *
+                                        multipliers['empire'] * multipliers['profit']))
         
         new_price = int(base_price * total_multiplier)
         
@@ -77,22 +66,26 @@ class GameLogic:
         return max(50, new_price)
     
     @staticmethod
-    def _calculate_liquidity_multiplier(user_id: int, cursor) -> float:
+    def calculate_price_multipliers(stats: Dict) -> Dict[str, float]:
+        """Calculate all price factors from get_price_analysis_bundle() output"""
+        return {
+            # Factor 1: Trading History (Liquidity)
+            'liquidity': GameLogic._calculate_liquidity_multiplier(stats),
+            # Factor 2: Income Stability
+            'stability': GameLogic._calculate_income_stability_multiplier(stats),
+            # Factor 3: Prisoner Empire Parameters
+            'empire': GameLogic._calculate_empire_multiplier(stats),
+            # Factor 4: Profit Performance
+            'profit': GameLogic._calculate_profit_multiplier(stats)
+        }
+    
+    @staticmethod
+    def _calculate_liquidity_multiplier(stats: Dict) -> float:
         """Calculate price multiplier based on trading history"""
-        # Get trading frequency (how many times bought/sold)
-        cursor.execute('''
-            SELECT COUNT(*) as trade_count,
-                   AVG(price) as avg_historical_price,
-                   MAX(price) as max_historical_price
-            FROM ownership_history 
-            WHERE prisoner_id = ?
-            AND timestamp > datetime('now', '-30 days')
-        ''', (user_id,))
-        
-        result = cursor.fetchone()
-        trade_count = result[0] if result else 0
-        avg_historical_price = result[1] if result and result[1] else 0
-        max_historical_price = result[2] if result and result[2] else 0
+        # Trading frequency (how many times bought/sold in the last 30 days)
+        trade_count = stats['trade_count']
+        avg_historical_price = stats['avg_trade_price'] or 0
+        max_historical_price = stats['max_trade_price'] or 0
         
         # Base multiplier from trading frequency
         if trade_count == 0:
@@ -105,8 +98,7 @@ class GameLogic:
             frequency_multiplier = 1.25  # High liquidity
         
         # Price trend multiplier
-        current_user = get_user(user_id)
-        current_price = current_user['price'] if current_user else 0
+        current_price = stats['price']
         
         if avg_historical_price > 0 and current_price > avg_historical_price:
             trend_multiplier = 1.1  # Price increasing trend
@@ -118,27 +110,14 @@ class GameLogic:
         return frequency_multiplier * trend_multiplier
     
     @staticmethod
-    def _calculate_income_stability_multiplier(user_id: int, cursor) -> float:
+    def _calculate_income_stability_multiplier(stats: Dict) -> float:
         """Calculate price multiplier based on income stability"""
-        # Get income history for last 7 days
-        cursor.execute('''
-            SELECT amount, timestamp
-            FROM income_log 
-            WHERE user_id = ?
-            AND timestamp > datetime('now', '-7 days')
-            ORDER BY timestamp DESC
-        ''', (user_id,))
-        
-        income_records = cursor.fetchall()
-        
-        if len(income_records) < 3:
+        # Income history for last 7 days
+        if stats['income_count'] < 3:
             return 1.0  # Not enough data
         
-        amounts = [record[0] for record in income_records]
-        avg_income = sum(amounts) / len(amounts)
-        
-        # Calculate income stability (lower variance = more stable)
-        variance = sum((x - avg_income) ** 2 for x in amounts) / len(amounts)
+        # Income stability (lower variance = more stable)
+        variance = stats['income_variance']
         stability_score = max(0, 100 - variance)  # Higher score = more stable
         
         # Convert stability to multiplier
@@ -152,19 +131,15 @@ class GameLogic:
             stability_multiplier = 1.0  # Unstable income
         
         # Bonus for consistent daily income
-        daily_income_count = len(set(record[1][:10] for record in income_records))  # Count unique days
-        if daily_income_count >= 5:  # Income for 5+ different days
+        if stats['income_days'] >= 5:  # Income for 5+ different days
             stability_multiplier *= 1.1
         
         return stability_multiplier
     
     @staticmethod
-    def _calculate_empire_multiplier(user_id: int, cursor) -> float:
+    def _calculate_empire_multiplier(stats: Dict) -> float:
         """Calculate price multiplier based on prisoner count and their parameters"""
-        from database import get_prisoner_upgrade_info
-        
-        prisoners = get_my_prisoners(user_id)
-        prisoner_count = len(prisoners)
+        prisoner_count = stats['prisoner_count']
         
         if prisoner_count == 0:
             return 0.9  # No prisoners = lower value
@@ -179,20 +154,9 @@ class GameLogic:
         else:
             count_multiplier = 1.1  # Few prisoners
         
-        # Calculate average prisoner value including upgrades
-        total_prisoner_value = 0
-        total_upgrade_investment = 0
-        
-        for prisoner in prisoners:
-            prisoner_value = prisoner['price']
-            upgrade_info = get_prisoner_upgrade_info(prisoner['telegram_id'])
-            upgrade_investment = upgrade_info['total_invested']
-            
-            total_prisoner_value += prisoner_value
-            total_upgrade_investment += upgrade_investment
-        
-        avg_prisoner_value = total_prisoner_value / prisoner_count if prisoner_count > 0 else 0
-        avg_upgrade_investment = total_upgrade_investment / prisoner_count if prisoner_count > 0 else 0
+        # Average prisoner value including upgrades
+        avg_prisoner_value = stats['prisoners_value'] / prisoner_count
+        avg_upgrade_investment = stats['upgrades_invested'] / prisoner_count
         
         # Quality multiplier based on average prisoner value
         if avg_prisoner_value >= 500:
@@ -216,21 +180,12 @@ class GameLogic:
         else:
             upgrade_multiplier = 1.0  # No upgrades
         
-        # Calculate empire growth trend (comparing recent vs older acquisitions)
-        cursor.execute('''
-            SELECT price, timestamp
-            FROM ownership_history 
-            WHERE new_owner_id = ?
-            ORDER BY timestamp DESC
-            LIMIT 10
-        ''', (user_id,))
-        
-        recent_purchases = cursor.fetchall()
+        # Empire growth trend (comparing the last 3 acquisitions with the 3 before them)
         growth_multiplier = 1.0
         
-        if len(recent_purchases) >= 5:
-            recent_avg = sum(p[0] for p in recent_purchases[:3]) / 3
-            older_avg = sum(p[0] for p in recent_purchases[3:6]) / 3 if len(recent_purchases) >= 6 else recent_avg
+        if stats['purchase_count'] >= 5:
+            recent_avg = stats['recent_purchase_avg']
+            older_avg = stats['older_purchase_avg'] if stats['purchase_count'] >= 6 else recent_avg
             
             if recent_avg > older_avg * 1.2:  # Buying increasingly expensive prisoners
                 growth_multiplier = 1.15
@@ -238,11 +193,9 @@ class GameLogic:
         return count_multiplier * quality_multiplier * upgrade_multiplier * growth_multiplier
     
     @staticmethod
-    def _calculate_profit_multiplier(user_id: int, cursor) -> float:
+    def _calculate_profit_multiplier(stats: Dict) -> float:
         """Calculate price multiplier based on profit generation and efficiency"""
-        from database import get_profit_statistics
-        
-        profit_stats = get_profit_statistics(user_id)
+        profit_stats = stats['profit']
         
         # Profit generation multiplier (how much money user generates for owners)
         avg_generated = profit_stats['avg_generated']
@@ -286,13 +239,14 @@ class GameLogic:
     @staticmethod
     def calculate_empire_value(user_id: int) -> Dict[str, int]:
         """Calculate total empire value for a user"""
-        prisoners = get_my_prisoners(user_id)
+        conn = get_db_connection()
+        cursor = conn.cursor()
         
-        total_value = 0
-        prisoner_count = len(prisoners)
+        # Totals are kept on the owner's row by triggers
+        cursor.execute('SELECT owned_count, owned_value FROM users WHERE telegram_id = ?', (user_id,))
         
-        for prisoner in prisoners:
-            total_value += prisoner['price']
+        row = cursor.fetchone()
+        prisoner_count, total_value = (row[0], row[1]) if row else (0, 0)
         
         return {
             'prisoner_count': prisoner_count,
@@ -378,8 +332,8 @@ class GameLogic:
         cursor.execute('''
             SELECT COALESCE(SUM(amount), 0) as daily_income
             FROM income_log
-            WHERE user_id = ? AND DATE(timestamp) = DATE('now')
-        ''', (user_id,))
+            WHERE user_id = ? AND timestamp >= ?
+        ''', (user_id, day_start_timestamp()))
         
         daily_income = cursor.fetchone()[0]
         
@@ -389,8 +343,8 @@ class GameLogic:
                 COALESCE(SUM(CASE WHEN transaction_type = 'purchase' THEN amount ELSE 0 END), 0) as spent,
                 COALESCE(SUM(CASE WHEN transaction_type = 'sale' THEN amount ELSE 0 END), 0) as earned
             FROM transactions
-            WHERE from_user_id = ? AND DATE(timestamp) = DATE('now')
-        ''', (user_id,))
+            WHERE from_user_id = ? AND timestamp >= ?
+        ''', (user_id, day_start_timestamp()))
         
         result = cursor.fetchone()
         daily_spent = result[0] if result else 0
@@ -420,8 +374,8 @@ class GameLogic:
         # Total transactions today
         cursor.execute('''
             SELECT COUNT(*) FROM transactions 
-            WHERE DATE(timestamp) = DATE('now')
-        ''')
+            WHERE timestamp >= ?
+        ''', (day_start_timestamp(),))
         daily_transactions = cursor.fetchone()[0]
         
         # Most expensive prisoner
@@ -546,8 +500,8 @@ class GameAnalytics:
         cursor.execute('''
             SELECT COUNT(*) FROM transactions 
             WHERE (from_user_id = ? OR to_user_id = ?)
-            AND timestamp > datetime('now', '-7 days')
-        ''', (user_id, user_id))
+            AND timestamp > ?
+        ''', (user_id, user_id, timestamp_cutoff(7)))
         
         recent_transactions = cursor.fetchone()[0]
         
@@ -572,10 +526,10 @@ class GameAnalytics:
                    COALESCE(SUM(t.amount), 0) as total_volume
             FROM users u
             LEFT JOIN transactions t ON (u.telegram_id = t.from_user_id OR u.telegram_id = t.to_user_id)
-            WHERE t.timestamp > datetime('now', '-30 days')
+            WHERE t.timestamp > ?
             GROUP BY u.telegram_id
             ORDER BY total_volume DESC
             LIMIT ?
-        ''', (limit,))
+        ''', (timestamp_cutoff(30), limit))
         
         return [dict(row) for row in cursor.fetchall()]
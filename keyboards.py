@@ -3,9 +3,15 @@ Keyboard layouts for Durov's Prison bot
 Contains all inline keyboard definitions
 """
 
+from functools import lru_cache
+from urllib.parse import quote
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from typing import List, Dict
+from typing import List, Dict, Tuple
+from database import display_name
 
+# Keyboards are immutable, so constant layouts are built once and shared
+
+@lru_cache(maxsize=1)
 def get_main_menu():
     """Get main menu keyboard"""
     keyboard = [
@@ -24,6 +30,7 @@ def get_main_menu():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=1)
 def get_profile_keyboard():
     """Get profile view keyboard"""
     keyboard = [
@@ -34,6 +41,13 @@ def get_profile_keyboard():
 
 def get_prisoners_keyboard(prisoners: List[Dict]):
     """Get keyboard for prisoners list"""
+    return _build_prisoners_keyboard(tuple(
+        (p['telegram_id'], display_name(p)) for p in prisoners
+    ))
+
+@lru_cache(maxsize=256)
+def _build_prisoners_keyboard(prisoners: Tuple[Tuple[int, str], ...]):
+    """Build prisoners list keyboard from (telegram_id, name) pairs"""
     keyboard = []
     
     # Add work management buttons if there are prisoners
@@ -48,11 +62,10 @@ def get_prisoners_keyboard(prisoners: List[Dict]):
     for i in range(0, len(prisoners), 3):
         row = []
         for j in range(i, min(i + 3, len(prisoners))):
-            prisoner = prisoners[j]
-            name = prisoner['username'] or prisoner['first_name'] or f"ID{prisoner['telegram_id']}"
+            prisoner_id, name = prisoners[j]
             row.append(InlineKeyboardButton(
                 f"👤 @{name[:10]}", 
-                callback_data=f"view_prisoner_{prisoner['telegram_id']}"
+                callback_data=f"v{prisoner_id}"
             ))
         keyboard.append(row)
     
@@ -67,15 +80,15 @@ def get_search_keyboard(prisoners: List[Dict]):
     
     # Add prisoner buttons with buy option
     for prisoner in prisoners:
-        name = prisoner['username'] or prisoner['first_name'] or f"ID{prisoner['telegram_id']}"
+        name = display_name(prisoner)
         keyboard.append([
             InlineKeyboardButton(
                 f"👁 @{name[:15]}", 
-                callback_data=f"view_profile_{prisoner['telegram_id']}"
+                callback_data=f"v{prisoner['telegram_id']}"
             ),
             InlineKeyboardButton(
                 f"💰 {prisoner['price']}", 
-                callback_data=f"buy_prisoner_{prisoner['telegram_id']}"
+                callback_data=f"b{prisoner['telegram_id']}"
             )
         ])
     
@@ -87,30 +100,24 @@ def get_search_keyboard(prisoners: List[Dict]):
     
     return InlineKeyboardMarkup(keyboard)
 
-def get_prisoner_profile_keyboard(prisoner_id: int, viewer_id: int):
-    """Get keyboard for prisoner profile view"""
-    from database import get_user
-    
-    prisoner = get_user(prisoner_id)
+def get_prisoner_profile_keyboard(prisoner: Dict, viewer_id: int, upgrade_cost: int = None):
+    """Get keyboard for prisoner profile view; upgrade_cost is needed when the viewer owns the prisoner"""
+    prisoner_id = prisoner['telegram_id']
     keyboard = []
     
     # If viewer owns this prisoner, show shield and upgrade buttons
     if prisoner['owner_id'] == viewer_id:
-        from database import get_prisoner_upgrade_info
-        
         shield_cost = int(prisoner['price'] * 0.35)
-        upgrade_info = get_prisoner_upgrade_info(prisoner_id)
-        upgrade_cost = upgrade_info['next_cost']
         
         keyboard.append([
-            InlineKeyboardButton(f"🛡️ Щит за {shield_cost} монет", callback_data=f"shield_{prisoner_id}"),
-            InlineKeyboardButton(f"⬆️ Улучшить за {upgrade_cost} монет", callback_data=f"upgrade_{prisoner_id}")
+            InlineKeyboardButton(f"🛡️ Щит за {shield_cost} монет", callback_data=f"S{prisoner_id}"),
+            InlineKeyboardButton(f"⬆️ Улучшить за {upgrade_cost} монет", callback_data=f"u{prisoner_id}")
         ])
     
     # If this is the user's own profile and they are owned by someone, show self-buyout
     if prisoner_id == viewer_id and prisoner['owner_id']:
         keyboard.append([
-            InlineKeyboardButton(f"🆓 Выкупить свободу за {prisoner['price']} монет", callback_data=f"self_buyout_{prisoner_id}")
+            InlineKeyboardButton(f"🆓 Выкупить свободу за {prisoner['price']} монет", callback_data=f"s{prisoner_id}")
         ])
     
     # Add buy button if not owned by viewer and not viewing own profile
@@ -118,13 +125,13 @@ def get_prisoner_profile_keyboard(prisoner_id: int, viewer_id: int):
         keyboard.append([
             InlineKeyboardButton(
                 f"💰 Купить за {prisoner['price']} монет", 
-                callback_data=f"buy_prisoner_{prisoner_id}"
+                callback_data=f"b{prisoner_id}"
             )
         ])
     
     # Add history button
     keyboard.append([
-        InlineKeyboardButton("📚 История", callback_data=f"history_{prisoner_id}")
+        InlineKeyboardButton("📚 История", callback_data=f"h{prisoner_id}")
     ])
     
     # Add back button
@@ -134,6 +141,7 @@ def get_prisoner_profile_keyboard(prisoner_id: int, viewer_id: int):
     
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=1)
 def get_transfer_keyboard():
     """Get transfer/balance keyboard"""
     keyboard = [
@@ -142,6 +150,7 @@ def get_transfer_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=1)
 def get_leaderboard_keyboard():
     """Get leaderboard category selection keyboard"""
     keyboard = [
@@ -156,6 +165,7 @@ def get_leaderboard_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=1)
 def get_back_keyboard():
     """Get simple back button keyboard"""
     keyboard = [
@@ -163,9 +173,9 @@ def get_back_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=1024)
 def get_invite_keyboard(referral_link):
     """Get keyboard for invite link with share button"""
-    from urllib.parse import quote
     share_text = quote("🪤 Попался! Заходи в Тюрьму Дурова и начинай зарабатывать!")
     share_url = f"https://t.me/share/url?url={quote(referral_link)}&text={share_text}"
     
@@ -175,6 +185,7 @@ def get_invite_keyboard(referral_link):
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=256)
 def get_confirmation_keyboard(action_data: str):
     """Get confirmation keyboard for actions"""
     keyboard = [
@@ -185,6 +196,7 @@ def get_confirmation_keyboard(action_data: str):
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=1)
 def get_find_prisoner_menu_keyboard():
     """Get keyboard for prisoner search options"""
     keyboard = [
@@ -204,19 +216,26 @@ def get_find_prisoner_menu_keyboard():
 
 def get_search_results_keyboard(prisoners: List[Dict], sort_by=None, search_term=None):
     """Get keyboard for search results with prisoner selection"""
+    return _build_search_results_keyboard(tuple(
+        (p['telegram_id'], display_name(p), p['price'])
+        for p in prisoners
+    ), sort_by, bool(search_term))
+
+@lru_cache(maxsize=256)
+def _build_search_results_keyboard(prisoners: Tuple[Tuple[int, str, int], ...], sort_by, is_search: bool):
+    """Build search results keyboard from (telegram_id, name, price) triples"""
     keyboard = []
     
     # Add prisoner selection buttons
-    for prisoner in prisoners:
-        name = prisoner['username'] or prisoner['first_name'] or f"ID{prisoner['telegram_id']}"
+    for prisoner_id, name, price in prisoners:
         keyboard.append([
-            InlineKeyboardButton(f"👤 @{name} - {prisoner['price']} монет", 
-                               callback_data=f"prisoner_profile_{prisoner['telegram_id']}")
+            InlineKeyboardButton(f"👤 @{name} - {price} монет", 
+                               callback_data=f"v{prisoner_id}")
         ])
     
     # Add navigation buttons
     nav_buttons = []
-    if search_term:
+    if is_search:
         nav_buttons.append(InlineKeyboardButton("🔍 Новый поиск", callback_data="search_by_username"))
     else:
         nav_buttons.append(InlineKeyboardButton("🔄 Обновить", callback_data=f"sort_{sort_by}" if sort_by else "sort_random"))
@@ -228,6 +247,7 @@ def get_search_results_keyboard(prisoners: List[Dict], sort_by=None, search_term
     
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=1)
 def get_back_to_find_keyboard():
     """Get keyboard to return to prisoner search"""
     keyboard = [
@@ -6,7 +6,7 @@ Main entry point for the bot application
 
 import os
 import logging
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, Defaults, filters
 from database import init_database
 from bot_handlers import (
     start_handler, button_handler, message_handler, 
@@ -38,8 +38,9 @@ def main():
     # Initialize database
     init_database()
     
-    # Create application
-    application = Application.builder().token(bot_token).build()
+    # Create application; all messages are HTML and handlers don't block the update loop
+    defaults = Defaults(parse_mode='HTML', block=False)
+    application = Application.builder().token(bot_token).defaults(defaults).build()
     
     # Set bot instance for notifications
     set_bot_instance(application.bot)
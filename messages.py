@@ -312,3 +312,37 @@ EMPTY_SEARCH_MESSAGE = """🔍 <b>Поиск не дал результатов!
 
 Все заключённые либо слишком дорогие, либо уже разобраны.
 Попробуй ещё раз или создай ловушку для новых жертв! 😈"""
+
+PRICE_ANALYSIS_MESSAGE = """📊 <b>Анализ стоимости игрока</b>
+
+👤 <b>Текущая цена:</b> {base_price} монет
+
+🔍 <b>Факторы ценообразования:</b>
+
+📈 <b>История торговли (×{liquidity_mult:.2f}):</b>
+• Сделок за месяц: {trade_count}
+• Средняя цена: {avg_trade_price} монет
+• Максимальная цена: {max_trade_price} монет
+
+💰 <b>Стабильность дохода (×{stability_mult:.2f}):</b>
+• Дней с доходом: {income_count}
+• Средний доход: {avg_income} монет/день
+
+🏛️ <b>Империя заключённых (×{empire_mult:.2f}):</b>
+• Количество заключённых: {prisoner_count}
+• Средняя стоимость: {avg_prisoner_value} монет
+• Вложено в улучшения: {avg_upgrade_investment} монет
+
+💼 <b>Прибыльность (×{profit_mult:.2f}):</b>
+• Приносит прибыли: {avg_generated} монет/день
+• Получает дохода: {avg_received} монет/день
+• Чистая прибыль: {net_profit} монет
+
+🎯 <b>Итоговый множитель:</b> ×{total_mult:.2f}
+
+💡 <b>Как повысить цену:</b>
+• Покупайте и продавайте чаще (ликвидность)
+• Получайте стабильный доход каждый день
+• Собирайте и улучшайте дорогих заключённых
+• Увеличивайте прибыльность для владельца
+• Активно участвуйте в торговле"""
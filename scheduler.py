@@ -5,10 +5,14 @@ Handles periodic tasks like hourly income generation
 
 import logging
 import asyncio
+import random
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.triggers.cron import CronTrigger
-from database import generate_hourly_income, get_db_connection
+from database import (
+    generate_hourly_income, get_db_connection, invalidate_user_caches, get_all_price_analysis_bundles,
+    timestamp_cutoff, day_start_timestamp
+)
 from game_logic import GameLogic
 
 logger = logging.getLogger(__name__)
@@ -68,6 +72,15 @@ def start_scheduler():
             replace_existing=True
         )
         
+        # Planner statistics refresh (every 4 hours)
+        scheduler.add_job(
+            optimize_database_sync,
+            trigger=IntervalTrigger(hours=4),
+            id='optimize_database',
+            name='Refresh query planner statistics',
+            replace_existing=True
+        )
+        
         scheduler.start()
         logger.info("Background scheduler started successfully")
     except Exception as e:
@@ -125,8 +138,8 @@ def update_daily_statistics_sync():
             SELECT 
                 DATE('now') as date,
                 (SELECT COUNT(*) FROM users) as total_users,
-                (SELECT COUNT(*) FROM transactions WHERE DATE(timestamp) = DATE('now')) as total_transactions,
-                (SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE DATE(timestamp) = DATE('now')) as total_volume,
+                (SELECT COUNT(*) FROM transactions WHERE timestamp >= :day_start) as total_transactions,
+                (SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE timestamp >= :day_start) as total_volume,
                 (SELECT AVG(price) FROM users) as avg_price,
                 (SELECT telegram_id FROM users u 
                  LEFT JOIN users p ON u.telegram_id = p.owner_id 
@@ -134,7 +147,7 @@ def update_daily_statistics_sync():
                  ORDER BY COUNT(p.telegram_id) DESC 
                  LIMIT 1) as top_user_by_prisoners,
                 (SELECT telegram_id FROM users ORDER BY balance DESC LIMIT 1) as top_user_by_balance
-        ''')
+        ''', {'day_start': day_start_timestamp()})
         
         conn.commit()
         logger.info("Daily statistics updated successfully")
@@ -151,8 +164,6 @@ def simulate_market_changes_sync():
         cursor = conn.cursor()
         
         # Small random price adjustments (±5%) for market dynamics
-        import random
-        
         cursor.execute('SELECT telegram_id, price FROM users')
         users = cursor.fetchall()
         
@@ -167,6 +178,7 @@ def simulate_market_changes_sync():
         if updates:
             cursor.executemany('UPDATE users SET price = ? WHERE telegram_id = ?', updates)
             conn.commit()
+            invalidate_user_caches()
             logger.info(f"Updated prices for {len(updates)} users")
         
     except Exception as e:
@@ -177,19 +189,19 @@ def update_dynamic_prices_sync():
     try:
         logger.info("Updating dynamic prices for all players...")
         
-        from game_logic import GameLogic
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Get all users
-        cursor.execute('SELECT telegram_id, price FROM users')
-        users = cursor.fetchall()
+        # Price factors for all users in one grouped query
+        all_stats = get_all_price_analysis_bundles()
         
         updates_count = 0
-        for user_id, current_price in users:
+        for user_id, stats in all_stats.items():
             try:
+                current_price = stats['price']
+                
                 # Calculate new dynamic price
-                new_price = GameLogic.calculate_dynamic_price(user_id)
+                new_price = GameLogic.calculate_price_from_stats(stats)
                 
                 # Only update if price changed significantly (more than 5% difference)
                 price_change_percent = abs(new_price - current_price) / current_price if current_price > 0 else 0
@@ -205,6 +217,7 @@ def update_dynamic_prices_sync():
                 continue
         
         conn.commit()
+        invalidate_user_caches()
         logger.info(f"Dynamic pricing update completed - updated {updates_count} players")
         
     except Exception as e:
@@ -212,34 +225,45 @@ def update_dynamic_prices_sync():
 
 def cleanup_old_data_sync():
     """Clean up old data to keep database size manageable"""
+    conn = get_db_connection()
     try:
         logger.info("Starting database cleanup...")
         
-        conn = get_db_connection()
         cursor = conn.cursor()
         
         # Keep only last 30 days of income logs
         cursor.execute('''
             DELETE FROM income_log 
-            WHERE timestamp < datetime('now', '-30 days')
-        ''')
+            WHERE timestamp < ?
+        ''', (timestamp_cutoff(30),))
         
         # Keep only last 90 days of transactions
         cursor.execute('''
             DELETE FROM transactions 
-            WHERE timestamp < datetime('now', '-90 days')
+            WHERE timestamp < ?
             AND transaction_type != 'purchase'  -- Keep all purchase records
-        ''')
-        
-        # Vacuum database to reclaim space
-        cursor.execute('VACUUM')
+        ''', (timestamp_cutoff(90),))
         
+        # Vacuum database to reclaim space; VACUUM cannot run inside a transaction
         conn.commit()
+        cursor.execute('VACUUM')
         logger.info("Database cleanup completed")
         
     except Exception as e:
+        if conn.in_transaction:
+            conn.rollback()
         logger.error(f"Error during database cleanup: {e}")
 
+def optimize_database_sync():
+    """Refresh planner statistics for tables that have grown since the last ANALYZE"""
+    try:
+        conn = get_db_connection()
+        conn.execute('PRAGMA optimize')
+        logger.info("Database statistics optimized")
+        
+    except Exception as e:
+        logger.error(f"Error optimizing database: {e}")
+
 # Keep async versions for manual triggers
 async def generate_hourly_income_job_async():
     """Async job to generate hourly income for all users"""
@@ -48,7 +48,7 @@ def test_bot_functionality():
     
     # Test money transfer
     print('4. Testing money transfer...')
-    success, message = transfer_money(user1_id, user3_id, 50)
+    success, message, sender_balance, recipient_balance = transfer_money(user1_id, user3_id, 50)
     print(f'   Transfer result: {success} - {message}')
     
     print('\nAll core features tested successfully!')
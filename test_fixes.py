@@ -5,12 +5,18 @@ Test script to verify admin commands and user purchase functionality
 
 import sys
 import os
+import asyncio
+import threading
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+import bot_handlers
 from database import (
     init_database, create_user, get_user, buy_prisoner,
     admin_add_coins, admin_set_coins, admin_get_user_by_username,
-    admin_get_all_users
+    admin_get_all_users, get_user_by_username, buy_self_freedom, transfer_money,
+    search_prisoners_by_username, get_db_connection, invalidate_user_caches, display_name
 )
 
 def test_admin_functions():
@@ -35,10 +41,9 @@ def test_admin_functions():
     
     # Test admin_add_coins
     print("Testing admin_add_coins...")
-    success = admin_add_coins(123456, 1000)
-    if success:
-        updated_user = get_user(123456)
-        print(f"✅ Added 1000 coins. New balance: {updated_user['balance']}")
+    new_balance = admin_add_coins(123456, 1000)
+    if new_balance is not None:
+        print(f"✅ Added 1000 coins. New balance: {new_balance}")
     else:
         print("❌ Failed to add coins")
         return False
@@ -98,13 +103,239 @@ def test_admin_list_users():
     if users:
         print(f"✅ Found {len(users)} users in database:")
         for i, user in enumerate(users[:5], 1):  # Show first 5
-            name = user['username'] or user['first_name'] or f"ID{user['telegram_id']}"
+            name = display_name(user)
             print(f"  {i}. @{name} - {user['balance']} coins, {user['prisoner_count']} prisoners")
         return True
     else:
         print("❌ No users found or error occurred")
         return False
 
+def reset_test_users(*telegram_ids):
+    """Remove test users and their history so a test can be re-run"""
+    conn = get_db_connection()
+    placeholders = ','.join('?' * len(telegram_ids))
+    conn.execute(f'DELETE FROM ownership_history WHERE prisoner_id IN ({placeholders})', telegram_ids)
+    conn.execute(f'DELETE FROM transactions WHERE from_user_id IN ({placeholders}) OR to_user_id IN ({placeholders})',
+                 telegram_ids + telegram_ids)
+    conn.execute(f'UPDATE users SET owner_id = NULL WHERE owner_id IN ({placeholders})', telegram_ids)
+    conn.execute(f'DELETE FROM users WHERE telegram_id IN ({placeholders})', telegram_ids)
+    conn.commit()
+    invalidate_user_caches()
+
+def test_concurrent_double_buy():
+    """Two buyers racing for the same prisoner: the purchases run one after the other"""
+    print("\n=== Testing Concurrent Purchase ===")
+    init_database()
+    buyer1, buyer2, prisoner_id = 910000001, 910000002, 910000003
+    reset_test_users(buyer1, buyer2, prisoner_id)
+    for telegram_id, name in ((buyer1, "racebuyer1"), (buyer2, "racebuyer2"), (prisoner_id, "raceprisoner")):
+        create_user(telegram_id, name, name)
+    admin_add_coins(buyer1, 1000)
+    admin_add_coins(buyer2, 1000)
+    
+    barrier = threading.Barrier(2)
+    results = {}
+    
+    def buy(buyer_id):
+        barrier.wait()
+        results[buyer_id] = buy_prisoner(buyer_id, prisoner_id)
+    
+    threads = [threading.Thread(target=buy, args=(buyer_id,)) for buyer_id in (buyer1, buyer2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    # The loser either sees the first purchase and pays the raised price,
+    # or is turned away - it never buys from the same stale row
+    conn = get_db_connection()
+    history = conn.execute('''
+        SELECT old_owner_id, new_owner_id, price FROM ownership_history
+        WHERE prisoner_id = ? ORDER BY id
+    ''', (prisoner_id,)).fetchall()
+    winners = [buyer_id for buyer_id, (success, _) in results.items() if success]
+    assert len(history) == len(winners) >= 1, (history, results)
+    assert [tuple(row) for row in history] == [(None, history[0][1], 100), (history[0][1], history[-1][1], 130)][:len(history)], history
+    assert conn.execute('SELECT owner_id FROM users WHERE telegram_id = ?', (prisoner_id,)).fetchone()[0] == history[-1][1]
+    for buyer_id, (success, _) in results.items():
+        if not success:
+            # 300 starting coins plus the 1000 credited above, untouched
+            assert conn.execute('SELECT balance FROM users WHERE telegram_id = ?', (buyer_id,)).fetchone()[0] == 1300
+    print(f"✅ Purchases were serialized: {len(history)} went through")
+
+def test_purchase_respects_late_shield():
+    """A shield activated after buy_prisoner's cached check still blocks the purchase"""
+    print("\n=== Testing Purchase Against A Late Shield ===")
+    init_database()
+    owner, buyer, prisoner_id = 910000041, 910000042, 910000043
+    reset_test_users(owner, buyer, prisoner_id)
+    create_user(owner, "shieldowner", "Owner")
+    create_user(buyer, "shieldbuyer", "Buyer")
+    create_user(prisoner_id, "shieldprisoner", "Prisoner", referrer_id=owner)
+    admin_add_coins(buyer, 1000)
+    
+    # Warm the cache, then shield the prisoner behind its back
+    assert not get_user(prisoner_id)['shield_active']
+    conn = get_db_connection()
+    conn.execute('''
+        UPDATE users SET shield_active = TRUE, shield_until = datetime('now', '+24 hours') WHERE telegram_id = ?
+    ''', (prisoner_id,))
+    conn.commit()
+    
+    success, message = buy_prisoner(buyer, prisoner_id)
+    assert not success, message
+    assert conn.execute('SELECT owner_id FROM users WHERE telegram_id = ?', (prisoner_id,)).fetchone()[0] == owner
+    assert conn.execute('SELECT balance FROM users WHERE telegram_id = ?', (buyer,)).fetchone()[0] == 1300
+    assert not conn.in_transaction
+    print("✅ The late shield blocked the purchase")
+
+def test_self_buyout_with_stale_cache():
+    """Self-buyout checks the database row, not a cached copy"""
+    print("\n=== Testing Self-Buyout With Stale Cache ===")
+    init_database()
+    first_owner, second_owner, prisoner_id = 910000011, 910000012, 910000013
+    reset_test_users(first_owner, second_owner, prisoner_id)
+    create_user(first_owner, "staleowner1", "Owner 1")
+    create_user(second_owner, "staleowner2", "Owner 2")
+    create_user(prisoner_id, "staleprisoner", "Prisoner", referrer_id=first_owner)
+    admin_add_coins(prisoner_id, 1000)
+    
+    # Warm the cache, then change the row behind its back
+    assert get_user(prisoner_id)['owner_id'] == first_owner
+    conn = get_db_connection()
+    conn.execute('UPDATE users SET balance = 0 WHERE telegram_id = ?', (prisoner_id,))
+    conn.commit()
+    
+    success, message = buy_self_freedom(prisoner_id)
+    assert not success, message
+    row = conn.execute('SELECT owner_id, balance FROM users WHERE telegram_id = ?', (prisoner_id,)).fetchone()
+    assert tuple(row) == (first_owner, 0), tuple(row)
+    
+    # A re-sale the cache has not seen: history must name the real owner
+    get_user(prisoner_id)
+    conn.execute('UPDATE users SET owner_id = ?, balance = 1000 WHERE telegram_id = ?', (second_owner, prisoner_id))
+    conn.commit()
+    
+    success, message = buy_self_freedom(prisoner_id)
+    assert success, message
+    old_owner = conn.execute('''
+        SELECT old_owner_id FROM ownership_history
+        WHERE prisoner_id = ? AND new_owner_id IS NULL ORDER BY id DESC LIMIT 1
+    ''', (prisoner_id,)).fetchone()[0]
+    assert old_owner == second_owner, old_owner
+    assert not conn.in_transaction
+    print("✅ Self-buyout used the current owner and balance")
+
+def test_owned_totals_follow_ownership():
+    """owned_count and owned_value stay in step with purchases, self-buyouts and transfers"""
+    print("\n=== Testing Owned Totals ===")
+    init_database()
+    first_owner, second_owner, prisoner_id = 910000031, 910000032, 910000033
+    reset_test_users(first_owner, second_owner, prisoner_id)
+    create_user(first_owner, "totalsowner1", "Owner 1")
+    create_user(second_owner, "totalsowner2", "Owner 2")
+    create_user(prisoner_id, "totalsprisoner", "Prisoner", referrer_id=first_owner)
+    admin_add_coins(second_owner, 1000)
+    conn = get_db_connection()
+    
+    def totals(telegram_id):
+        row = conn.execute('SELECT owned_count, owned_value FROM users WHERE telegram_id = ?', (telegram_id,)).fetchone()
+        return tuple(row)
+    
+    assert totals(first_owner) == (1, 100), totals(first_owner)
+    
+    success, message = buy_prisoner(second_owner, prisoner_id)
+    assert success, message
+    new_price = get_user(prisoner_id)['price']
+    assert totals(first_owner) == (0, 0), totals(first_owner)
+    assert totals(second_owner) == (1, new_price), totals(second_owner)
+    assert admin_get_user_by_username("totalsowner2")['prisoner_count'] == 1
+    
+    # Moving money does not touch ownership
+    success, message, _, _ = transfer_money(second_owner, first_owner, 50)
+    assert success, message
+    assert totals(second_owner) == (1, new_price), totals(second_owner)
+    assert totals(first_owner) == (0, 0), totals(first_owner)
+    
+    admin_add_coins(prisoner_id, new_price)
+    success, message = buy_self_freedom(prisoner_id)
+    assert success, message
+    assert totals(second_owner) == (0, 0), totals(second_owner)
+    print("✅ Owned totals followed every ownership change")
+
+
+def test_ambiguous_username_resolves_to_nobody():
+    """Username lookups refuse to pick one of several users whose names differ only in case"""
+    print("\n=== Testing Ambiguous Usernames ===")
+    init_database()
+    single, first_dup, second_dup = 910000051, 910000052, 910000053
+    reset_test_users(single, first_dup, second_dup)
+    create_user(single, "SoleName", "Single")
+    create_user(first_dup, "TwinName", "Twin 1")
+    create_user(second_dup, "twinname", "Twin 2")
+    
+    assert get_user_by_username("solename")['telegram_id'] == single
+    assert admin_get_user_by_username("SOLENAME")['telegram_id'] == single
+    assert get_user_by_username("TwinName") is None
+    assert admin_get_user_by_username("twinname") is None
+    print("✅ Ambiguous usernames matched nobody")
+
+def test_username_search_ignores_case():
+    """Username search finds users regardless of letter case"""
+    print("\n=== Testing Username Search ===")
+    init_database()
+    searcher, target = 910000021, 910000022
+    reset_test_users(searcher, target)
+    create_user(searcher, "casesearcher", "Searcher")
+    create_user(target, "MixedCaseTarget", "Target")
+    
+    for term in ("mixedcase", "MIXEDCASE", "caseTar"):
+        found = [p['telegram_id'] for p in search_prisoners_by_username(term, searcher)]
+        assert target in found, (term, found)
+    print("✅ Search matched every letter case")
+
+
+def test_callback_routing():
+    """Compact and legacy callback data reach the same handlers"""
+    print("\n=== Testing Callback Routing ===")
+    calls = []
+    
+    def recorder(name):
+        async def record(query, *args):
+            calls.append((name, *args))
+        return record
+    
+    saved = {table: dict(getattr(bot_handlers, table)) for table in ('PRISONER_ACTIONS', 'ARGUMENT_ACTIONS')}
+    try:
+        for key in ('v', 'view_profile', 'S', 'shield', 's', 'self_buyout'):
+            bot_handlers.PRISONER_ACTIONS[key] = recorder(key)
+        for key in ('sort', 'leaderboard'):
+            bot_handlers.ARGUMENT_ACTIONS[key] = recorder(key)
+        
+        expected = {
+            'v42': ('v', 42),
+            'view_profile_42': ('view_profile', 42),
+            'S7': ('S', 7),
+            'shield_7': ('shield', 7),
+            's9': ('s', 9),
+            'self_buyout_9': ('self_buyout', 9),
+            'sort_price_asc': ('sort', 'price_asc'),
+            'leaderboard_balance': ('leaderboard', 'balance'),
+        }
+        for data, call in expected.items():
+            calls.clear()
+            query = SimpleNamespace(data=data, answer=AsyncMock(), from_user=SimpleNamespace(id=1))
+            update = SimpleNamespace(callback_query=query)
+            context = SimpleNamespace(user_data={})
+            asyncio.run(bot_handlers.button_handler(update, context))
+            assert calls == [call], (data, calls)
+    finally:
+        for table, actions in saved.items():
+            getattr(bot_handlers, table).clear()
+            getattr(bot_handlers, table).update(actions)
+    print("✅ Every callback reached its handler")
+
+
 def main():
     """Run all tests"""
     print("🧪 Testing Bot Fixes...")
@@ -125,6 +356,15 @@ def main():
             print("❌ Admin user list test failed")
             return
         
+        # Behavioral checks raise AssertionError on failure
+        test_concurrent_double_buy()
+        test_purchase_respects_late_shield()
+        test_self_buyout_with_stale_cache()
+        test_owned_totals_follow_ownership()
+        test_ambiguous_username_resolves_to_nobody()
+        test_username_search_ignores_case()
+        test_callback_routing()
+        
         print("\n🎉 All tests passed! Bot fixes are working correctly.")
         
     except Exception as e: